@@ -0,0 +1,436 @@
+#
+# Benchmark of the looper, npz_addup and drift_plotter on synthetic TIQ files
+#
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import multiprocessing
+import xml.etree.ElementTree as et
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import numpy as np
+from loguru import logger
+
+from tiq_stream import get_streamed_spectrogram
+from fft_engine import FFTEngine
+from fast_render import render_spectrogram_png
+from npz_format import save_spectrogram, save_spectrum
+from looper_metrics import StageTimer
+
+TIQ_NAMESPACE = "{http://www.tek.com/cda/TekIQFile}"
+
+TIQ_HEADER = """<DataFile offset="{offset:010d}" version="1.0" xmlns="http://www.tek.com/cda/TekIQFile">
+  <DataSetsCollection xmlns="http://www.tek.com/cda/DataSetsCollection">
+    <DataSets version="1.0" xmlns="http://www.tek.com/cda/TekIQFile">
+      <DataDescription>
+        <NumberSamples type="System.Int64">{nsamples}</NumberSamples>
+        <DateTime type="System.DateTime">{date_time}</DateTime>
+        <NumberFormat type="System.String">Int32</NumberFormat>
+        <Endian type="System.String">Little</Endian>
+        <Scaling type="System.Double">{scale!r}</Scaling>
+        <SamplingFrequency type="System.Double">{fs!r}</SamplingFrequency>
+        <Frequency type="System.Double">{center!r}</Frequency>
+        <AcquisitionBandwidth type="System.Double">{span!r}</AcquisitionBandwidth>
+      </DataDescription>
+    </DataSets>
+  </DataSetsCollection>
+</DataFile>
+"""
+
+
+def write_synthetic_tiq(
+    filename,
+    nsamples,
+    fs=312500.0,
+    center=245e6,
+    tones=((10e3, 0.5),),
+    noise=0.05,
+    scale=1e-9,
+    date_time=None,
+    seed=0,
+    chunk_samples=1 << 20,
+):
+    """
+    Write a TIQ file with nsamples complex samples: the tones given as
+    (offset from center in Hz, amplitude in full scale) plus gaussian noise.
+    Samples are written in chunks, so the file can be larger than memory.
+    """
+    date_time = date_time or datetime.now()
+    fields = dict(
+        nsamples=nsamples,
+        date_time=date_time.isoformat(),
+        scale=scale,
+        fs=fs,
+        center=center,
+        span=fs / 1.25,
+    )
+    # Data starts at a 4 kB boundary, the rest of the header is padding
+    offset = -(-len(TIQ_HEADER.format(offset=0, **fields)) // 4096) * 4096
+    header = TIQ_HEADER.format(offset=offset, **fields)
+    full_scale = 2**30
+    rng = np.random.default_rng(seed)
+
+    with open(filename, "wb") as file:
+        file.write(header.encode().ljust(offset, b" "))
+        for start in range(0, nsamples, chunk_samples):
+            n = min(chunk_samples, nsamples - start)
+            t = (start + np.arange(n)) / fs
+            signal = rng.normal(0, noise / np.sqrt(2), (n, 2)).view(np.complex128)[:, 0]
+            for offset_hz, amplitude in tones:
+                signal += amplitude * np.exp(2j * np.pi * offset_hz * t)
+            iq = np.empty((n, 2), dtype="<i4")
+            iq[:, 0] = np.clip(signal.real * full_scale, -(2**31), 2**31 - 1)
+            iq[:, 1] = np.clip(signal.imag * full_scale, -(2**31), 2**31 - 1)
+            iq.tofile(file)
+
+
+def read_tiq_header(filename):
+    """
+    The header fields of a TIQ file the streaming readers need, parsed the
+    same way as iqtools does, so the stages can be timed without it.
+    """
+    with open(filename, "rb") as file:
+        line = file.readline().decode()
+        data_offset = int(line.split('"')[1])
+        file.seek(0)
+        root = et.fromstring(file.read(data_offset))
+
+    def field(tag, convert=float):
+        return convert(next(root.iter(TIQ_NAMESPACE + tag)).text)
+
+    return SimpleNamespace(
+        filename=filename,
+        data_offset=data_offset,
+        nsamples_total=field("NumberSamples", int),
+        scale=field("Scaling"),
+        fs=field("SamplingFrequency"),
+        center=field("Frequency"),
+    )
+
+
+def make_files(directory, nfiles, nsamples, fs, drift_hz):
+    """
+    nfiles synthetic TIQ files one second apart, named like the ones of the
+    RSA, the tone moves by drift_hz from file to file.
+    """
+    start = datetime(2026, 1, 1, 12, 0, 0)
+    files = []
+    for i in range(nfiles):
+        date_time = start + timedelta(seconds=i)
+        name = f"rsa01-{date_time.strftime('%Y.%m.%d.%H.%M.%S')}.000.tiq"
+        write_synthetic_tiq(
+            os.path.join(directory, name),
+            nsamples,
+            fs=fs,
+            tones=((10e3 + i * drift_hz, 0.5), (-40e3, 0.05)),
+            date_time=date_time,
+            seed=i,
+        )
+        files.append(name)
+    return files
+
+
+def bench_readiness(directory, files, repeat=5):
+    """
+    Time of one scan of the ReadinessTracker over all files.
+    """
+    try:
+        from looper import ReadinessTracker
+    except ImportError as e:
+        return {"skipped": f"looper can not be imported: {e}"}
+
+    tracker = ReadinessTracker(file_ready_seconds=0)
+    tracker.update(directory, files)  # first scan only records the files
+    timer = StageTimer()
+    for _ in range(repeat):
+        with timer("scan"):
+            ready = tracker.update(directory, files)
+    return {
+        "files": len(files),
+        "ready": len(ready),
+        "scan_seconds": round(timer.seconds["scan"] / repeat, 6),
+    }
+
+
+def get_output_format(settings):
+    """
+    NPZ layout, dtype and compression the looper writes, as in process_file.
+    """
+    return dict(
+        dtype=settings["analysis"].get("output_dtype", "float64"),
+        compress=settings["analysis"].get("output_compress", False),
+        legacy=settings["analysis"].get("output_layout", "legacy") == "legacy",
+    )
+
+
+def get_renderer(settings):
+    """
+    The spectrogram PNG renderer of the looper, None if it can not be used
+    here: the matplotlib one comes with looper, which needs iqtools.
+    """
+    try:
+        from looper import render_spectrogram
+
+        return render_spectrogram
+    except ImportError as e:
+        if settings["analysis"].get("renderer", "matplotlib") != "fast":
+            logger.warning(f"Not timing the PNG render, looper can not be imported: {e}")
+            return None
+
+    def render_spectrogram(ff, tt, zz, center, filename, settings):
+        output_dir = os.path.join(settings["paths"]["output_dir"], "")
+        render_spectrogram_png(
+            zz,
+            output_dir + filename + "_spectrogram.png",
+            zzmin=settings["analysis"]["zzmin"],
+            zzmax=settings["analysis"]["zzmax"],
+            dbm=settings["analysis"]["dbm"],
+            mask=settings["analysis"]["mask"],
+            width=settings["analysis"].get("png_width", 1024),
+        )
+        return filename + "_spectrogram.png"
+
+    return render_spectrogram
+
+
+def bench_stages(
+    filename, output_dir, nframes, lframes, navg, block_frames, reader, settings, render_spectrogram
+):
+    """
+    Time read, FFT, averaging, NPZ write and PNG render of one file with
+    the streaming reader, writing as the looper does with settings and
+    rendering with render_spectrogram from get_renderer.
+    """
+    timer = StageTimer()
+    settings = dict(settings, paths=dict(settings["paths"], output_dir=output_dir))
+    output_format = get_output_format(settings)
+
+    with timer("read"):
+        iq = read_tiq_header(filename)
+    ff, tt, zz = get_streamed_spectrogram(
+        iq,
+        nframes,
+        lframes,
+        navg,
+        block_frames,
+        mapped=reader == "mmap",
+        engine=FFTEngine(),
+        timer=timer,
+    )
+    name = os.path.basename(filename)
+    with timer("npz_write"):
+        save_spectrogram(
+            os.path.join(output_dir, name + "_spectrogram.npz"), ff + iq.center, tt, zz, **output_format
+        )
+        save_spectrum(
+            os.path.join(output_dir, name + "_spectrum.npz"), ff + iq.center, zz.mean(axis=0), **output_format
+        )
+    if render_spectrogram is not None:
+        with timer("png_render"):
+            render_spectrogram(ff, tt, zz, iq.center, name, settings)
+
+    result = timer.result()
+    result["total"] = round(sum(timer.seconds.values()), 6)
+    return result
+
+
+def bench_looper(directory, files, output_dir, settings, num_cores):
+    """
+    Files per second and bytes per second of looper.process_file on a pool
+    of num_cores workers, as the looper runs it.
+    """
+    try:
+        from looper import process_file, init_worker
+    except ImportError as e:
+        return {"skipped": f"looper can not be imported: {e}"}
+
+    settings = dict(settings, paths=dict(settings["paths"], monitor_dir=directory, output_dir=output_dir))
+    total_bytes = sum(os.path.getsize(os.path.join(directory, f)) for f in files)
+    start_time = time.perf_counter()
+    with multiprocessing.Pool(num_cores, initializer=init_worker) as pool:
+        results = pool.starmap(process_file, [(f, settings) for f in files])
+    seconds = time.perf_counter() - start_time
+    return {
+        "files": len(files),
+        "seconds": round(seconds, 6),
+        "files_per_second": round(len(files) / seconds, 3),
+        "bytes_per_second": round(total_bytes / seconds, 1),
+        "mean_file_seconds": round(np.mean([r["duration"] for r in results]), 6),
+    }
+
+
+def bench_addup(output_dir, jobs):
+    """
+    Time of npz_addup.process_files over the spectrograms of one run.
+    """
+    try:
+        import npz_addup
+    except ImportError as e:
+        return {"skipped": f"npz_addup can not be imported: {e}"}
+
+    file_list = os.path.join(output_dir, "spectrogram_files.txt")
+    with open(file_list, "w") as file:
+        names = sorted(f for f in os.listdir(output_dir) if f.endswith("_spectrogram.npz"))
+        file.write("\n".join(os.path.join(output_dir, f) for f in names))
+    args = argparse.Namespace(
+        file_list=file_list,
+        time_cut=None,
+        shift_track=True,
+        peak_window=None,
+        subbin=False,
+        pwr_limit=None,
+        jobs=jobs,
+        chunk_size=16,
+        index=None,
+        verbose=False,
+    )
+    start_time = time.perf_counter()
+    npz_addup.process_files(args)
+    seconds = time.perf_counter() - start_time
+    return {"files": len(names), "jobs": jobs, "seconds": round(seconds, 6)}
+
+
+def bench_drift(output_dir, jobs):
+    """
+    Time of collecting the drift points of all spectra of one run.
+    """
+    try:
+        from drift_plotter import collect_drift_points
+    except ImportError as e:
+        return {"skipped": f"drift_plotter can not be imported: {e}"}
+
+    files = sorted(
+        os.path.join(output_dir, f) for f in os.listdir(output_dir) if f.endswith("_spectrum.npz")
+    )
+    start_time = time.perf_counter()
+    with multiprocessing.Pool(jobs) as pool:
+        points = collect_drift_points(files, None, pool)
+    seconds = time.perf_counter() - start_time
+    return {"files": len(files), "points": len(points), "jobs": jobs, "seconds": round(seconds, 6)}
+
+
+def load_settings(config_file):
+    import tomli
+
+    with open(config_file, "rb") as file:
+        return tomli.load(file)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time the stages of the looper, npz_addup and drift_plotter on "
+        "synthetic TIQ files and write the results as JSON."
+    )
+    parser.add_argument("-c", "--config", default="looper_cfg.toml", help="Looper configuration, the analysis options are used for the looper runs (default: looper_cfg.toml)")
+    parser.add_argument("-o", "--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("-d", "--work-dir", help="Directory for the synthetic files, a temporary one is used and removed if not given")
+    parser.add_argument("--nfiles", type=int, default=8, help="Number of synthetic TIQ files (default: 8)")
+    parser.add_argument("--nframes", type=int, nargs="+", default=[700], help="Values of nframes to run (default: 700)")
+    parser.add_argument("--lframes", type=int, nargs="+", default=[8192], help="Values of lframes to run (default: 8192)")
+    parser.add_argument("--num-cores", type=int, nargs="+", default=[1, os.cpu_count()], help="Pool sizes for the throughput runs (default: 1 and all cores)")
+    parser.add_argument("--navg", type=int, default=2, help="Frames averaged per row (default: 2)")
+    parser.add_argument("--block-frames", type=int, default=64, help="Frames read at a time (default: 64)")
+    parser.add_argument("--reader", choices=["stream", "mmap"], default="stream", help="Reader for the stage timings (default: stream)")
+    parser.add_argument("--fs", type=float, default=312500.0, help="Sampling frequency of the synthetic files (default: 312500)")
+    parser.add_argument("--drift", type=float, default=5.0, help="Drift of the tone from file to file in Hz (default: 5)")
+    args = parser.parse_args()
+
+    settings = load_settings(args.config)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="looper_benchmark_")
+    tiq_dir = os.path.join(work_dir, "tiq")
+    os.makedirs(tiq_dir, exist_ok=True)
+
+    nsamples = max(args.nframes) * max(args.lframes)
+    logger.info(f"Writing {args.nfiles} synthetic files of {nsamples} samples to {tiq_dir}.")
+    files = make_files(tiq_dir, args.nfiles, nsamples, args.fs, args.drift)
+    render_spectrogram = get_renderer(settings)
+
+    results = {
+        "date": datetime.now().isoformat(),
+        "host": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "cpu_count": os.cpu_count(),
+            "fft_backend": FFTEngine().backend,
+        },
+        "synthetic": {
+            "files": args.nfiles,
+            "samples": nsamples,
+            "file_bytes": os.path.getsize(os.path.join(tiq_dir, files[0])),
+            "fs": args.fs,
+        },
+        "readiness": bench_readiness(tiq_dir, files),
+        "stages": [],
+        "looper": [],
+        "npz_addup": [],
+        "drift_plotter": [],
+    }
+
+    try:
+        for nframes in args.nframes:
+            for lframes in args.lframes:
+                config = {"nframes": nframes, "lframes": lframes, "navg": args.navg}
+                output_dir = os.path.join(work_dir, f"out_{nframes}_{lframes}")
+                os.makedirs(output_dir, exist_ok=True)
+
+                logger.info(f"Stage timings for nframes {nframes}, lframes {lframes}.")
+                timings = [
+                    bench_stages(
+                        os.path.join(tiq_dir, f),
+                        output_dir,
+                        nframes,
+                        lframes,
+                        args.navg,
+                        args.block_frames,
+                        args.reader,
+                        settings,
+                        render_spectrogram,
+                    )
+                    for f in files
+                ]
+                stages = {
+                    stage: round(float(np.median([t[stage] for t in timings])), 6)
+                    for stage in timings[0]
+                }
+                output_format = get_output_format(settings)
+                results["stages"].append(
+                    dict(
+                        config,
+                        reader=args.reader,
+                        output_layout="legacy" if output_format["legacy"] else "compact",
+                        output_dtype=output_format["dtype"],
+                        output_compress=output_format["compress"],
+                        renderer=settings["analysis"].get("renderer", "matplotlib"),
+                        **stages,
+                    )
+                )
+
+                for num_cores in args.num_cores:
+                    run_settings = dict(settings, analysis=dict(settings["analysis"], **config))
+                    results["looper"].append(
+                        dict(config, num_cores=num_cores, **bench_looper(tiq_dir, files, output_dir, run_settings, num_cores))
+                    )
+                    results["npz_addup"].append(dict(config, **bench_addup(output_dir, num_cores)))
+                    results["drift_plotter"].append(dict(config, **bench_drift(output_dir, num_cores)))
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+        logger.info(f"Results written to {args.output}.")
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
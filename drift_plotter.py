@@ -1,15 +1,177 @@
 import sys, os
+import time
+import multiprocessing
 import numpy as np
 import matplotlib.pyplot as plt
-from datetime import datetime
 import argparse
 from loguru import logger
 from tqdm import tqdm
+from npz_format import get_peak_frequency
+from spectra_index import SpectraIndex, source_name, parse_timestamp
+
+def get_drift_point(filepath):
+    """
+    Time stamp and f_max of one spectrum file, None if it can not be read.
+    Runs in the worker processes.
+    """
+    if not os.path.isfile(filepath):
+        return None
+    try:
+        return parse_timestamp(filepath), get_peak_frequency(filepath)
+    except Exception as e:
+        logger.error(f"Failed to read {filepath}: {e}")
+        return None
+
+
+def collect_drift_points(spectrum_files, index_file, pool):
+    """
+    Time stamp and f_max of the spectrum files, from the looper index if
+    given, the rest is read by the worker pool. Returns a dict by file.
+    """
+    # Time stamps and f_max of the files the looper has indexed
+    indexed = {}
+    if index_file is not None:
+        index = SpectraIndex(index_file)
+        indexed = index.lookup(spectrum_files)
+        index.close()
+        logger.info(f"{len(indexed)} files found in the index.")
+
+    points = {}
+    for filepath in spectrum_files:
+        row = indexed.get(source_name(filepath))
+        if (
+            row is not None
+            and row["timestamp"] is not None
+            and row["spectrum_peak_freq"] is not None
+        ):
+            points[filepath] = (row["timestamp"], row["spectrum_peak_freq"])
+
+    # Read the other files in parallel, with progress tracking using tqdm
+    to_read = [f for f in spectrum_files if f not in points]
+    if to_read:
+        results = pool.imap(get_drift_point, to_read, chunksize=64)
+        for filepath, point in zip(to_read, tqdm(results, total=len(to_read), desc="Processing files", unit="file")):
+            if point is not None:
+                points[filepath] = point
+    return points
+
+
+def replace_file(filename, write):
+    """
+    Write via a temporary file and rename, so readers never see a half written file.
+    """
+    base, ext = os.path.splitext(filename)
+    tmp_file = f"{base}.tmp{ext}"
+    write(tmp_file)
+    os.replace(tmp_file, filename)
+
+
+def write_drift_txt(filename, timestamps, f_max_values, mode="w"):
+    with open(filename, mode) as f:
+        if mode == "w":
+            f.write("# Timestamp, f_max\n")
+        f.writelines(f"{t} {f_max}\n" for t, f_max in zip(timestamps, f_max_values))
+
+
+def save_drift_npz(files, timestamps, f_max_values, output_npz="output.npz"):
+    replace_file(
+        output_npz,
+        lambda tmp_file: np.savez(
+            tmp_file,
+            filename=np.array(files, dtype=str),
+            timestamp=np.array(timestamps, dtype="datetime64[us]"),
+            f_max=np.array(f_max_values, dtype=np.float64),
+        ),
+    )
+
+
+def save_drift(files, timestamps, f_max_values, output_txt="output.txt", output_npz="output.npz"):
+    """
+    Write the drift as columns to an NPZ file and as text.
+    """
+    save_drift_npz(files, timestamps, f_max_values, output_npz)
+    replace_file(output_txt, lambda tmp_file: write_drift_txt(tmp_file, timestamps, f_max_values))
+    logger.info(f"Timestamps and f_max values saved to {output_txt} and {output_npz}")
+
+
+def load_drift(output_npz="output.npz"):
+    """
+    Files, time stamps and f_max covered by an earlier run, empty if there was none.
+    """
+    if not os.path.isfile(output_npz):
+        return [], [], []
+    with np.load(output_npz) as data:
+        if "filename" not in data.files:
+            logger.warning(f"{output_npz} has no file column, starting from scratch.")
+            return [], [], []
+        timestamps = data["timestamp"].astype("datetime64[us]").astype(object)
+        return list(data["filename"]), list(timestamps), list(data["f_max"])
+
+
+def plot_drift(timestamps, f_max_values, output_png="output.png"):
+    # Plot timestamps and f_max values
+    plt.figure(figsize=(10, 6))
+    plt.plot(timestamps, f_max_values, marker='o', linestyle='-')
+    plt.xlabel("Timestamp")
+    plt.ylabel("f_max")
+    plt.title("f_max vs Timestamp")
+    plt.xticks(rotation=45)
+    plt.tight_layout()
+
+    # Save the plot as a PNG file without showing it
+    replace_file(output_png, plt.savefig)
+    plt.close()
+    logger.info(f"Plot saved to {output_png}")
+
+
+def read_file_list(file_list_path):
+    # Read file paths from the text file
+    with open(file_list_path, "r") as f:
+        file_paths = [line.strip() for line in f if line.strip()]
+    return [f for f in file_paths if f.endswith("_spectrum.npz")]
+
+
+def follow(args, pool):
+    """
+    Keep the drift up to date: every args.follow seconds the file list is
+    read again and only spectra not covered yet are processed and appended.
+    """
+    files, timestamps, f_max_values = load_drift()
+    covered = set(files)
+    logger.info(f"Continuing with {len(covered)} spectra covered already.")
+    if files:
+        save_drift(files, timestamps, f_max_values)
+
+    while True:
+        new_files = [f for f in read_file_list(args.file_list) if f not in covered]
+        points = collect_drift_points(new_files, args.index, pool) if new_files else {}
+        new_files = [f for f in new_files if f in points]
+        if new_files:
+            new_timestamps, new_f_max_values = zip(*(points[f] for f in new_files))
+            files.extend(new_files)
+            timestamps.extend(new_timestamps)
+            f_max_values.extend(new_f_max_values)
+
+            if covered:
+                # The text file only grows, the others are replaced
+                write_drift_txt("output.txt", new_timestamps, new_f_max_values, mode="a")
+                save_drift_npz(files, timestamps, f_max_values)
+            else:
+                # Nothing written by this run yet, replace a stale text file with header
+                save_drift(files, timestamps, f_max_values)
+            covered.update(new_files)
+            plot_drift(timestamps, f_max_values)
+            logger.info(f"Added {len(new_files)} spectra, {len(files)} in total.")
+        time.sleep(args.follow)
+
 
 def main():
     # Argument parsing
     parser = argparse.ArgumentParser(description="Process .npz files to extract f_max and plot results.")
     parser.add_argument("file_list", type=str, help="Path to the text file containing a list of .npz file paths")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of processes reading files (default: all cores)")
+    parser.add_argument("-f", "--follow", type=float, required=False, help="Keep running, add new spectra from the file list every this many seconds (optional)")
+    parser.add_argument("-i", "--index", type=str, required=False, help="Looper index file, indexed files are not opened (optional)")
     args = parser.parse_args()
 
     # Validate the provided file list
@@ -20,62 +182,34 @@ def main():
 
     # Read file paths from the text file
     try:
-        with open(file_list_path, "r") as f:
-            file_paths = [line.strip() for line in f if line.strip()]
+        spectrum_files = read_file_list(file_list_path)
     except Exception as e:
         logger.error(f"Failed to read file list: {e}")
         sys.exit(1)
 
-    # Lists to store timestamps and f_max values
-    timestamps = []
-    f_max_values = []
-
-    # Flag to check for matching files
-    found_matching_files = False
+    with multiprocessing.Pool(max(1, args.jobs)) as pool:
+        if args.follow is not None:
+            try:
+                follow(args, pool)
+            except KeyboardInterrupt:
+                logger.info("Stopped following.")
+            return
 
-    # Loop through the file paths with progress tracking using tqdm
-    for filepath in tqdm(file_paths, desc="Processing files", unit="file"):
-        if filepath.endswith("_spectrum.npz") and os.path.isfile(filepath):
-            found_matching_files = True  # Set flag to True when a matching file is found
+        points = collect_drift_points(spectrum_files, args.index, pool)
 
-            # Extract the timestamp from the filename
-            filename = os.path.basename(filepath)
-            timestamp_str = filename.split('-')[1].split('.tiq')[0]
-            timestamp = datetime.strptime(timestamp_str, '%Y.%m.%d.%H.%M.%S.%f')
-            timestamps.append(timestamp)
-
-            # Load data from the .npz file
-            data = np.load(filepath)
-            ff, pp = data['arr_0'], data['arr_1']
-
-            # Find f_max
-            f_max = ff[np.argmax(pp)]
-            f_max_values.append(f_max)
+    # Keep the order of the file list
+    drift = [(f,) + points[f] for f in spectrum_files if f in points]
 
     # Handle case when no matching files are found
-    if not found_matching_files:
+    if not drift:
         logger.warning("No files matching the pattern '_spectrum.npz' were found in the file list.")
         sys.exit(1)
 
-    # Write timestamps and f_max values to a TXT file
-    output_txt = "output.txt"
-    np.savetxt(output_txt, np.column_stack((timestamps, f_max_values)), 
-               fmt='%s', header="Timestamp, f_max")
-    logger.info(f"Timestamps and f_max values saved to {output_txt}")
+    files, timestamps, f_max_values = zip(*drift)
 
-    # Plot timestamps and f_max values
-    plt.figure(figsize=(10, 6))
-    plt.plot(timestamps, f_max_values, marker='o', linestyle='-')
-    plt.xlabel("Timestamp")
-    plt.ylabel("f_max")
-    plt.title("f_max vs Timestamp")
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-
-    # Save the plot as a PNG file without showing it
-    output_png = "output.png"
-    plt.savefig(output_png)
-    logger.info(f"Plot saved to {output_png}")
+    # Write timestamps and f_max values to the output files
+    save_drift(files, timestamps, f_max_values)
+    plot_drift(timestamps, f_max_values)
 
 if __name__ == "__main__":
     logger.add("script.log", format="{time} {level} {message}", level="DEBUG", rotation="1 MB", compression="zip")
@@ -0,0 +1,104 @@
+#
+# Fast spectrogram to PNG rendering without matplotlib figures
+#
+
+import zlib
+import struct
+import numpy as np
+import matplotlib
+
+
+def get_colormap_lut(cmap="jet", ncolors=256):
+    """
+    RGB lookup table of a matplotlib colormap as uint8 array of shape (ncolors, 3).
+    """
+    colors = matplotlib.colormaps[cmap](np.linspace(0, 1, ncolors))
+    return (colors[:, :3] * 255).round().astype(np.uint8)
+
+
+def pool_axis(zz, size, axis, pooling="max"):
+    """
+    Reduce zz along axis to at most size bins by max or mean pooling.
+    The last bins that do not fill a whole pool are dropped.
+    """
+    length = np.shape(zz)[axis]
+    factor = -(-length // size)  # ceil
+    if factor <= 1:
+        return zz
+    n = length // factor
+    zz = np.moveaxis(zz, axis, -1)[..., : n * factor]
+    zz = zz.reshape(zz.shape[:-1] + (n, factor))
+    zz = zz.max(axis=-1) if pooling == "max" else zz.mean(axis=-1)
+    return np.moveaxis(zz, -1, axis)
+
+
+def write_png(filename, rgb):
+    """
+    Write an RGB uint8 array of shape (height, width, 3) as PNG.
+    """
+    height, width, _ = np.shape(rgb)
+    # Filter type 0 (none) in front of every row
+    raw = np.empty((height, width * 3 + 1), dtype=np.uint8)
+    raw[:, 0] = 0
+    raw[:, 1:] = rgb.reshape(height, width * 3)
+
+    def chunk(tag, data):
+        return (
+            struct.pack(">I", len(data))
+            + tag
+            + data
+            + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+        )
+
+    with open(filename, "wb") as file:
+        file.write(b"\x89PNG\r\n\x1a\n")
+        file.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        file.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), 3)))
+        file.write(chunk(b"IEND", b""))
+
+
+def render_spectrogram_png(
+    zz,
+    filename,
+    zzmin=0,
+    zzmax=1e6,
+    dbm=False,
+    mask=False,
+    cmap="jet",
+    width=1024,
+    height=None,
+    pooling="max",
+):
+    """
+    Map the spectrogram zz (time along rows) to colors and write it as PNG,
+    first time at the bottom as in the matplotlib plots.
+
+    The scaling follows plot_spectrogram: without dbm and for
+    0 <= zzmin < zzmax <= 1e6, zz is normalized to a maximum of 1e6 and
+    clipped to [zzmin, zzmax]. With dbm, zz is converted to dBm and zzmin,
+    zzmax are taken as dBm limits if zzmin < zzmax. Otherwise the color
+    range follows the data. With mask, pixels below zzmin stay white.
+    """
+    zz = pool_axis(zz, width, axis=1, pooling=pooling)
+    if height:
+        zz = pool_axis(zz, height, axis=0, pooling=pooling)
+    # Empty or broken captures must still give an image, not NaN indices
+    zz = np.nan_to_num(np.asarray(zz, dtype=np.float64), nan=0.0, posinf=0.0, neginf=0.0)
+
+    if dbm:
+        zz = 10 * np.log10(np.maximum(zz, np.finfo(np.float64).tiny) * 1000)
+        limits = zzmin < zzmax
+    else:
+        limits = zzmin >= 0 and zzmax <= 1e6 and zzmin < zzmax
+        if limits and np.max(zz) > 0:
+            zz = zz / np.max(zz) * 1e6
+    vmin, vmax = (zzmin, zzmax) if limits else (np.min(zz), np.max(zz))
+
+    lut = get_colormap_lut(cmap)
+    scale = (len(lut) - 1) / (vmax - vmin) if vmax > vmin else 0
+    index = np.clip((zz - vmin) * scale, 0, len(lut) - 1).astype(np.intp)
+    rgb = lut[index]
+    if mask:
+        rgb[zz < vmin] = 255
+
+    write_png(filename, rgb[::-1])
@@ -0,0 +1,98 @@
+#
+# Batched FFT with cached plans for the looper
+#
+
+import os
+import pickle
+import numpy as np
+from loguru import logger
+
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
+
+try:
+    import scipy.fft
+except ImportError:
+    scipy = None
+
+
+class FFTEngine:
+    """
+    FFT along the rows of a 2D array of frames in one call.
+
+    With pyfftw, one plan per frame length and dtype is built with
+    FFTW_MEASURE for the largest number of frames seen and kept for the
+    lifetime of the engine. Fewer frames, like the last block of a file,
+    are zero padded into it instead of measuring a plan of their own. The
+    wisdom is stored in wisdom_file so the next run does not have to
+    measure again. Without pyfftw, scipy.fft
+    or numpy.fft is used, which cache their twiddle factors by themselves.
+    """
+
+    def __init__(self, threads=1, wisdom_file=None):
+        self.threads = threads
+        self.wisdom_file = wisdom_file
+        self.plans = {}
+        if pyfftw is not None and wisdom_file and os.path.exists(wisdom_file):
+            try:
+                with open(wisdom_file, "rb") as file:
+                    pyfftw.import_wisdom(pickle.load(file))
+            except Exception as e:
+                logger.warning(f"Could not import FFTW wisdom from {wisdom_file}: {e}")
+
+    @property
+    def backend(self):
+        if pyfftw is not None:
+            return "pyfftw"
+        return "scipy" if scipy is not None else "numpy"
+
+    def get_plan(self, shape, dtype):
+        """
+        Plan and padding buffer for at least shape[0] frames of shape[1].
+        """
+        key = (shape[1], np.dtype(dtype).str)
+        entry = self.plans.get(key)
+        if entry is None or entry[0].input_shape[0] < shape[0]:
+            # Planning with FFTW_MEASURE overwrites the input, so use a scratch array
+            buffer = pyfftw.empty_aligned(shape, dtype=dtype)
+            plan = pyfftw.builders.fft(
+                buffer,
+                axis=1,
+                threads=self.threads,
+                planner_effort="FFTW_MEASURE",
+            )
+            entry = (plan, buffer)
+            self.plans[key] = entry
+            self.save_wisdom()
+        return entry
+
+    def save_wisdom(self):
+        if not self.wisdom_file:
+            return
+        # Several workers may write at the same time, replace atomically
+        tmp_file = f"{self.wisdom_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, "wb") as file:
+                pickle.dump(pyfftw.export_wisdom(), file)
+            os.replace(tmp_file, self.wisdom_file)
+        except OSError as e:
+            logger.warning(f"Could not save FFTW wisdom to {self.wisdom_file}: {e}")
+
+    def fft(self, frames):
+        """
+        FFT of every row. With pyfftw the returned array belongs to the plan
+        and is overwritten by the next call with the same shape.
+        """
+        if pyfftw is not None:
+            plan, buffer = self.get_plan(frames.shape, frames.dtype)
+            n = len(frames)
+            if n == len(buffer):
+                return plan(frames)
+            buffer[:n] = frames
+            buffer[n:] = 0
+            return plan(buffer)[:n]
+        if scipy is not None:
+            return scipy.fft.fft(frames, axis=1, workers=self.threads)
+        return np.fft.fft(frames, axis=1)
@@ -6,17 +6,38 @@
 
 import os
 import time
+import signal
+import stat
+import select
+import struct
+import ctypes
+import ctypes.util
 import multiprocessing
 import pickle
+import json
+import socket
+import heapq
+import itertools
+import collections
 import tomli
 from loguru import logger
-from functools import partial
 import argparse
 from iqtools import *
+from tiq_stream import (
+    get_streamed_spectrogram,
+    get_integrated_spectrum,
+    get_sample_view,
+    get_auto_frames,
+)
+from fft_engine import FFTEngine
+from fast_render import render_spectrogram_png
+from npz_format import save_spectrogram, save_spectrum, load_spectrogram, load_spectrum
+from spectra_index import SpectraIndex, get_spectrogram_summary, get_spectrum_summary, parse_timestamp
+from looper_metrics import StageTimer, LooperMetrics, get_max_rss
+from output_distribution import DistributionStage
 
-
-# Declare the global variable
-PROCESSED_FILES = set()
+# FFT engine of this worker process, plans are kept between files
+FFT_ENGINE = None
 
 # font settings for plot
 font = {"weight": "bold", "size": 5}  #'family' : 'normal',
@@ -50,6 +71,12 @@ def read_and_verify_settings(toml_file):
                 if key not in config[section]:
                     raise KeyError(f"Missing key: {key} in section: {section}")
 
+        # Optional further analysis profiles
+        for profile in config["analysis"].get("profiles", []):
+            for key in ["name", "nframes", "lframes"]:
+                if key not in profile:
+                    raise KeyError(f"Missing key: {key} in analysis profile {profile}")
+
         logger.info("Settings successfully read and validated.")
         return config
 
@@ -63,43 +90,548 @@ def read_and_verify_settings(toml_file):
         raise
 
 
-# Load processed files state from disk
-def load_processed_files(state_file):
-    global PROCESSED_FILES
-    if os.path.exists(state_file):
+# Append-only journal of processed files, one JSON record per line
+class ProcessedJournal:
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.records = {}  # name -> record, last one wins
+        dirty = self.load()
+        # Files that failed are kept in the journal, but tried again
+        self.processed = {name for name, record in self.records.items() if "error" not in record}
+        if dirty:
+            self.compact()
+        self.file = open(self.state_file, "a")
+        logger.info(
+            f"Loaded {len(self.processed)} processed files from state, "
+            f"{len(self.records) - len(self.processed)} failed ones are tried again."
+        )
+
+    def load(self):
+        """
+        Read the journal, return True if it should be compacted.
+        """
+        state_file = self.state_file
+        if not os.path.exists(state_file):
+            # Pickled state of older looper versions next to the journal
+            state_file = os.path.splitext(self.state_file)[0] + ".pkl"
+            if not os.path.exists(state_file):
+                return False
+            logger.info(f"Importing processed files from {state_file}.")
+
         with open(state_file, "rb") as file:
-            PROCESSED_FILES = pickle.load(file)
-        logger.info(f"Loaded {len(PROCESSED_FILES)} processed files from state.")
+            content = file.read()
+
+        # Older looper versions pickled the whole set of file names
+        if content[:1] == b"\x80":
+            for name in pickle.loads(content):
+                self.records[name] = {"file": name}
+            logger.info("Converting pickled state file to journal.")
+            return True
+
+        lines = content.splitlines()
+        for line in lines:
+            try:
+                record = json.loads(line)
+                self.records[record["file"]] = record
+            except (ValueError, KeyError, TypeError):
+                # Most probably the tail of a write interrupted by a crash
+                logger.warning(f"Skipping broken line in {self.state_file}.")
+        return len(lines) != len(self.records)
+
+    def __contains__(self, name):
+        return name in self.processed
+
+    def __len__(self):
+        return len(self.processed)
+
+    def record(self, name, **info):
+        """
+        Append one processed file and flush it to disk.
+        """
+        record = {"file": name, **info}
+        self.records[name] = record
+        if "error" in record:
+            self.processed.discard(name)
+        else:
+            self.processed.add(name)
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def compact(self):
+        """
+        Rewrite the journal with one line per file, then atomically replace it.
+        """
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, "w") as file:
+            for record in self.records.values():
+                file.write(json.dumps(record) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_file, self.state_file)
+        logger.info(f"Compacted state file to {len(self.records)} records.")
+
+    def close(self):
+        self.file.close()
+
+
+# Lease files in a directory shared by several looper instances, possibly on
+# other hosts, so that every file is processed by one of them only
+class WorkClaims:
+    def __init__(self, claims_dir, lease_seconds=120, node=None):
+        os.makedirs(claims_dir, exist_ok=True)
+        self.claims_dir = claims_dir
+        self.lease_seconds = lease_seconds
+        self.owner = f"{node or socket.gethostname()}.{os.getpid()}"
+        self.held = {}  # file -> owner, files other instances have claimed
+        self.last_check = time.monotonic()
+
+    def get_path(self, file, suffix):
+        return os.path.join(self.claims_dir, file + suffix)
+
+    def read_owner(self, path):
+        try:
+            with open(path) as claim:
+                return json.load(claim).get("owner")
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def claim(self, file):
+        """
+        Take the lease on a file, returns False if another instance holds it
+        or has processed it already.
+        """
+        lease = self.get_path(file, ".lease")
+        if not os.path.exists(self.get_path(file, ".done")):
+            for _ in range(2):
+                try:
+                    # O_EXCL makes the creation atomic, also on NFS v3 and later
+                    fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+                except FileExistsError:
+                    if not self.break_expired(lease):
+                        break
+                    continue
+                with os.fdopen(fd, "w") as claim:
+                    json.dump({"owner": self.owner, "time": time.time()}, claim)
+                return True
+        self.held[file] = self.read_owner(lease)
+        return False
+
+    def break_expired(self, lease):
+        """
+        Remove a lease that was not renewed in time, returns True if the
+        file can be claimed again.
+        """
+        try:
+            age = time.time() - os.stat(lease).st_mtime
+        except FileNotFoundError:
+            return True  # Released meanwhile
+        if age < self.lease_seconds:
+            return False
+        expired_owner = self.read_owner(lease)
+        # Only one of the instances breaking the lease wins the rename
+        stale = f"{lease}.{self.owner}.stale"
+        try:
+            os.rename(lease, stale)
+        except FileNotFoundError:
+            return False
+        # Another instance may have broken and claimed it again between the
+        # check and the rename, then the renamed lease is a fresh one
+        owner = self.read_owner(stale)
+        try:
+            age = time.time() - os.stat(stale).st_mtime
+        except FileNotFoundError:
+            return False
+        if age < self.lease_seconds or owner != expired_owner:
+            try:
+                os.link(stale, lease)  # Put it back, unless a new one exists
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+        logger.warning(f"Lease {lease} of {owner} expired, taking over.")
+        os.remove(stale)
+        return True
+
+    def maintain(self, in_flight):
+        """
+        Renew the leases of the files in flight and check the files held by
+        other instances. Returns the ones they finished, with the owner, and
+        the ones whose lease expired or was given up.
+        """
+        now = time.monotonic()
+        if now - self.last_check < self.lease_seconds / 4:
+            return [], []
+        self.last_check = now
+
+        for file in in_flight:
+            try:
+                os.utime(self.get_path(file, ".lease"))
+            except OSError as e:
+                logger.warning(f"Could not renew lease of {file}: {e}")
+
+        done, free = [], []
+        for file in list(self.held):
+            done_file = self.get_path(file, ".done")
+            if os.path.exists(done_file):
+                done.append((file, self.read_owner(done_file)))
+            else:
+                try:
+                    age = time.time() - os.stat(self.get_path(file, ".lease")).st_mtime
+                except FileNotFoundError:
+                    age = self.lease_seconds
+                if age < self.lease_seconds:
+                    continue
+                free.append(file)
+            del self.held[file]
+        return done, free
+
+    def release(self, file):
+        """
+        Mark a file as done for all instances and drop its lease.
+        """
+        done_file = self.get_path(file, ".done")
+        tmp_file = f"{done_file}.{self.owner}.tmp"
+        with open(tmp_file, "w") as claim:
+            json.dump({"owner": self.owner, "time": time.time()}, claim)
+        os.replace(tmp_file, done_file)
+        self.give_up(file)
+
+    def give_up(self, file):
+        """
+        Drop the lease of a file without marking it done, e.g. after an
+        error, so that another instance or the next start can take it.
+        """
+        try:
+            os.remove(self.get_path(file, ".lease"))
+        except FileNotFoundError:
+            pass
+
+
+# Track size and mtime of candidate files across scans, no sleeping
+class ReadinessTracker:
+    def __init__(self, file_ready_seconds):
+        self.file_ready_seconds = file_ready_seconds
+        self.seen = {}  # name -> (size, mtime, time of the last observed change)
+
+    def update(self, monitor_dir, candidates):
+        """
+        Stat all candidates once and return the ones whose size and mtime
+        did not change for at least file_ready_seconds across scans.
+        """
+        now = time.monotonic()
+        ready = []
+        seen = {}
+        for file in candidates:
+            try:
+                st = os.stat(os.path.join(monitor_dir, file))
+            except FileNotFoundError:
+                continue  # Vanished between listdir and stat
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            signature = (st.st_size, st.st_mtime_ns)
+            previous = self.seen.get(file)
+            if previous is None or previous[:2] != signature:
+                # New or still being written, start the clock again
+                seen[file] = signature + (now,)
+                if previous is not None:
+                    logger.debug(f"File {file} is still being written.")
+                continue
+            seen[file] = previous
+            if now - previous[2] >= self.file_ready_seconds:
+                logger.debug(f"File {file} is ready for processing.")
+                ready.append(file)
+        # Forget files that are gone or no longer candidates
+        self.seen = seen
+        return ready
+
 
+def is_tiq(name):
+    return name.lower().endswith(".tiq")
 
-# Save processed files state to disk
-def save_processed_files(state_file):
-    with open(state_file, "wb") as file:
-        pickle.dump(PROCESSED_FILES, file)
-    logger.info("Processed files state saved.")
 
+# Poll the directory listing, the default and the fallback watcher
+class PollingWatcher:
+    def __init__(self, monitor_dir, file_ready_seconds):
+        self.monitor_dir = monitor_dir
+        self.tracker = ReadinessTracker(file_ready_seconds)
 
-# Check if file is ready for processing
-def is_file_ready(filepath, settings):
+    def poll(self, timeout, is_known):
+        """
+        Return the files that became ready, after waiting for timeout seconds.
+        """
+        time.sleep(timeout)  # Monitor at regular intervals
+        candidates = [
+            f for f in os.listdir(self.monitor_dir) if is_tiq(f) and not is_known(f)
+        ]
+        return self.tracker.update(self.monitor_dir, candidates)
+
+    def close(self):
+        pass
+
+
+# Linux inotify, new files are reported when the writer closes or moves them in
+class InotifyWatcher:
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_Q_OVERFLOW = 0x00004000
+    EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+    def __init__(self, monitor_dir, file_ready_seconds):
+        self.monitor_dir = monitor_dir
+        self.tracker = ReadinessTracker(file_ready_seconds)
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = libc.inotify_add_watch(
+            self.fd,
+            os.fsencode(monitor_dir),
+            self.IN_CLOSE_WRITE | self.IN_MOVED_TO,
+        )
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed on {monitor_dir}")
+
+        # Files already there at startup, may still be written to
+        self.pending = set(f for f in os.listdir(monitor_dir) if is_tiq(f))
+
+    def read_events(self):
+        names = []
+        try:
+            buffer = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset < len(buffer):
+            _, mask, _, length = self.EVENT_HEADER.unpack_from(buffer, offset)
+            offset += self.EVENT_HEADER.size
+            name = buffer[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflowed, rescanning directory.")
+                self.pending.update(
+                    f for f in os.listdir(self.monitor_dir) if is_tiq(f)
+                )
+            elif name:
+                names.append(os.fsdecode(name))
+        return names
+
+    def poll(self, timeout, is_known):
+        """
+        Return the files that were closed after writing or moved in, waiting
+        at most timeout seconds for events.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        ready = []
+        if readable:
+            for name in self.read_events():
+                if is_tiq(name) and not is_known(name):
+                    self.pending.discard(name)
+                    ready.append(name)
+        if self.pending:
+            self.pending = set(f for f in self.pending if not is_known(f))
+            settled = self.tracker.update(self.monitor_dir, list(self.pending))
+            # Drop settled files and the ones that disappeared meanwhile
+            self.pending = set(self.tracker.seen).difference(settled)
+            ready.extend(settled)
+        return ready
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(settings):
+    monitor_dir = settings["paths"]["monitor_dir"]
     file_ready_seconds = settings["processing"]["file_ready_seconds"]
-    initial_size = os.path.getsize(filepath)
-    time.sleep(file_ready_seconds)  # Wait briefly
-    current_size = os.path.getsize(filepath)
-    ready = initial_size == current_size  # File size is stable
-    if ready:
-        logger.debug(f"File {filepath} is ready for processing.")
-    else:
-        logger.warning(f"File {filepath} is still being written.")
-    return ready
+    watch_mode = settings["processing"].get("watch_mode", "poll")
+
+    if watch_mode == "inotify":
+        try:
+            watcher = InotifyWatcher(monitor_dir, file_ready_seconds)
+            logger.info(f"Watching {monitor_dir} with inotify.")
+            return watcher
+        except (OSError, AttributeError, TypeError) as e:
+            logger.warning(f"inotify not available ({e}), falling back to polling.")
+    elif watch_mode != "poll":
+        logger.warning(f"Unknown watch_mode '{watch_mode}', using polling.")
+    return PollingWatcher(monitor_dir, file_ready_seconds)
+
+
+# Files waiting for a free worker, ordered by the schedule policy
+class FileScheduler:
+    def __init__(self, monitor_dir, policy="newest", max_age_minutes=0):
+        if policy not in ("newest", "fifo"):
+            logger.warning(f"Unknown schedule '{policy}', using newest first.")
+            policy = "newest"
+        self.monitor_dir = monitor_dir
+        self.policy = policy
+        self.max_age_minutes = max_age_minutes
+        self.heap = []
+        self.queued = set()
+        self.counter = itertools.count()  # arrival order, breaks ties
+
+    def get_time(self, file):
+        """
+        Time stamp of the file name as seconds since the epoch, the file
+        modification time for names without one.
+        """
+        try:
+            return parse_timestamp(file).timestamp()
+        except (IndexError, ValueError):
+            pass
+        try:
+            return os.stat(os.path.join(self.monitor_dir, file)).st_mtime
+        except OSError:
+            return time.time()
+
+    def add(self, files):
+        """
+        Queue files that became ready, returns the ones skipped for being
+        older than max_age_minutes.
+        """
+        skipped = []
+        now = time.time()
+        for file_time, file in sorted((self.get_time(f), f) for f in files):
+            if self.max_age_minutes and now - file_time > 60 * self.max_age_minutes:
+                skipped.append(file)
+                continue
+            priority = -file_time if self.policy == "newest" else 0
+            heapq.heappush(self.heap, (priority, next(self.counter), file))
+            self.queued.add(file)
+        return skipped
+
+    def pop(self):
+        _, _, file = heapq.heappop(self.heap)
+        self.queued.discard(file)
+        return file
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self, file):
+        return file in self.queued
+
+
+def get_fft_engine(settings):
+    global FFT_ENGINE
+    if FFT_ENGINE is None:
+        FFT_ENGINE = FFTEngine(
+            threads=settings["processing"].get("fft_threads", 1),
+            wisdom_file=settings["paths"].get("wisdom_file"),
+        )
+    return FFT_ENGINE
+
+
+def render_spectrogram(ff, tt, zz, center, filename, settings):
+    output_dir = os.path.join(settings["paths"]["output_dir"], "")
+    if settings["analysis"].get("renderer", "matplotlib") == "fast":
+        render_spectrogram_png(
+            zz,
+            output_dir + filename + "_spectrogram.png",
+            zzmin=settings["analysis"]["zzmin"],
+            zzmax=settings["analysis"]["zzmax"],
+            dbm=settings["analysis"]["dbm"],
+            mask=settings["analysis"]["mask"],
+            width=settings["analysis"].get("png_width", 1024),
+        )
+        return filename + "_spectrogram.png"
+
+    xx, yy = np.meshgrid(ff, tt)
+    plot_spectrogram(
+        xx,
+        yy,
+        zz,
+        cen=center,
+        zzmin=settings["analysis"]["zzmin"],
+        zzmax=settings["analysis"]["zzmax"],
+        dbm=settings["analysis"]["dbm"],
+        mask=settings["analysis"]["mask"],
+        filename=output_dir + filename + '_spectrogram',
+        title=filename,
+    )
+    return filename + "_spectrogram.png"
+
+
+def render_spectrum(ff, pp, center, filename, settings):
+    output_dir = os.path.join(settings["paths"]["output_dir"], "")
+    plot_spectrum(
+        ff,
+        pp,
+        cen=center,
+        span=None,
+        dbm=settings["analysis"]["dbm"],
+        filename=output_dir + filename + '_spectrum',
+        title=filename,
+    )
+    return filename + "_spectrum.png"
+
+
+# Render the PNGs of a processed file from its saved NPZ results
+def render_file(filename, center, settings):
+    output_dir = os.path.join(settings["paths"]["output_dir"], "")
+    todo = settings["analysis"]["todo"]
+    start_time = time.time()
+    outputs = []
+    profiles = settings["analysis"].get("profiles", [])
+    for name in [filename] + [f"{filename}_{p['name']}" for p in profiles]:
+        if "spectrogram" in todo:
+            ff, tt, zz = load_spectrogram(output_dir + name + "_spectrogram.npz")
+            outputs.append(render_spectrogram(ff - center, tt, zz, center, name, settings))
+        if "spectrum" in todo:
+            ff, pp = load_spectrum(output_dir + name + "_spectrum.npz")
+            outputs.append(render_spectrum(ff - center, pp, center, name, settings))
+    logger.info(f"Rendered {filename} in {time.time() - start_time:.2f} seconds.")
+    return outputs
+
+
+# One entry of analysis.profiles, from the samples mapped for all of them
+def process_profile(
+    iq, samples, filename, profile, sizes, settings, output_format, inline_png, timer
+):
+    output_dir = os.path.join(settings["paths"]["output_dir"], "")
+    todo = settings["analysis"]["todo"]
+    name = f"{filename}_{profile['name']}"
+    nframes, lframes, navg = sizes
+    outputs = []
+
+    ff, tt, zz = get_streamed_spectrogram(
+        iq,
+        nframes,
+        lframes,
+        navg,
+        settings["analysis"].get("block_frames", 64),
+        engine=get_fft_engine(settings),
+        timer=timer,
+        samples=samples,
+    )
+    if "spectrogram" in todo:
+        with timer("npz_write"):
+            save_spectrogram(
+                output_dir + name + "_spectrogram.npz", ff + iq.center, tt, zz, **output_format
+            )
+        outputs.append(name + "_spectrogram.npz")
+        if inline_png:
+            with timer("png_render"):
+                outputs.append(render_spectrogram(ff, tt, zz, iq.center, name, settings))
+    if "spectrum" in todo:
+        # Always integrated, the full length FFT does not depend on the profile
+        with timer("average"):
+            pp = get_integrated_spectrum(zz)
+        with timer("npz_write"):
+            save_spectrum(output_dir + name + "_spectrum.npz", ff + iq.center, pp, **output_format)
+        outputs.append(name + "_spectrum.npz")
+        if inline_png:
+            with timer("png_render"):
+                outputs.append(render_spectrum(ff, pp, iq.center, name, settings))
+    return outputs
 
 
 # Process the file
 def process_file(filename, settings):
     navg = settings["analysis"]["navg"]
-    zzmin = settings["analysis"]["zzmin"]
-    zzmax = settings["analysis"]["zzmax"]
-    dbm = settings["analysis"]["dbm"]
-    mask = settings["analysis"]["mask"]
     lframes = settings["analysis"]["lframes"]
     nframes = settings["analysis"]["nframes"]
     monitor_dir = settings["paths"]["monitor_dir"]
@@ -107,94 +639,408 @@ def process_file(filename, settings):
     output_dir = settings["paths"]["output_dir"]
     output_dir = os.path.join(output_dir, "")
     todo = settings["analysis"]["todo"]
+    reader = settings["analysis"].get("reader", "iqtools")
+    streaming = reader in ("stream", "mmap")
+    block_frames = settings["analysis"].get("block_frames", 64)
+    spectrum_mode = settings["analysis"].get("spectrum_mode", "fft")
+    # Integrate the spectrum from the frame powers instead of a second FFT
+    shared_spectrum = "spectrum" in todo and spectrum_mode == "spectrogram"
+    # With render workers the PNGs are made later from the NPZ files
+    inline_png = "png" in todo and settings["processing"].get("render_workers", 0) == 0
+    output_format = dict(
+        dtype=settings["analysis"].get("output_dtype", "float64"),
+        compress=settings["analysis"].get("output_compress", False),
+        legacy=settings["analysis"].get("output_layout", "legacy") == "legacy",
+    )
+
+    # Scalars for the sidecar index, written by the main process
+    indexing = settings["paths"].get("index_file") is not None
 
     start_time = time.time()  # Record start time
+    timer = StageTimer()
+    outputs = []
+    summary = {}
+
+    max_rows = settings["analysis"].get("max_rows", 0)
 
     # here comes the actual calculation
-    iq = get_iq_object(monitor_dir + filename)
-    iq.method = "fftw"
-    iq.read(nframes=nframes, lframes=lframes)
+    with timer("read"):
+        iq = get_iq_object(monitor_dir + filename)
+        iq.method = "fftw"
+        auto = "auto" in (nframes, lframes)
+        if streaming or auto:
+            iq.read_header()  # samples are read block by block
+        if auto:
+            # Size the job from the header, to cover the whole file
+            nframes, lframes, navg = get_auto_frames(
+                iq.nsamples_total, nframes, lframes, navg, max_rows
+            )
+        if not streaming:
+            iq.read(nframes=nframes, lframes=lframes)
+
+    # The main spectrogram of the streaming readers and the further profiles
+    # share one mapping of the samples, read once from disk
+    profiles = settings["analysis"].get("profiles", [])
+    sizes = [
+        get_auto_frames(iq.nsamples_total, p["nframes"], p["lframes"], p.get("navg", 1), max_rows)
+        for p in profiles
+    ]
+    samples = None
+    if reader == "mmap" or profiles:
+        nsamples = [n * l for n, l, _ in sizes]
+        if streaming:
+            nsamples.append(nframes * lframes)
+        with timer("read"):
+            samples = get_sample_view(iq, max(nsamples))
+
+    if "spectrogram" in todo or shared_spectrum:
+        if streaming:
+            ff, tt, zz = get_streamed_spectrogram(
+                iq,
+                nframes,
+                lframes,
+                navg,
+                block_frames,
+                mapped=reader == "mmap",
+                engine=get_fft_engine(settings),
+                timer=timer,
+                samples=samples,
+            )
+        else:
+            with timer("fft"):
+                xx, yy, zz = iq.get_power_spectrogram(nframes=nframes, lframes=lframes)
+            with timer("average"):
+                xx, yy, zz = get_averaged_spectrogram(xx, yy, zz, every=navg)
+            ff, tt = xx[0, :], yy[:, 0]
 
     if "spectrogram" in todo:
-        xx, yy, zz = iq.get_power_spectrogram(nframes=nframes, lframes=lframes)
-        xx, yy, zz = get_averaged_spectrogram(xx, yy, zz, every=navg)
-        np.savez(output_dir + filename + "_spectrogram.npz", xx + iq.center, yy, zz)
-
-        if "png" in todo:
-            plot_spectrogram(
-                xx,
-                yy,
+        with timer("npz_write"):
+            save_spectrogram(
+                output_dir + filename + "_spectrogram.npz",
+                ff + iq.center,
+                tt,
                 zz,
-                cen=iq.center,
-                zzmin=zzmin,
-                zzmax=zzmax,
-                dbm=dbm,
-                mask=mask,
-                filename=output_dir + filename + '_spectrogram',
-                title=filename,
+                **output_format,
             )
+        outputs.append(filename + "_spectrogram.npz")
+        if indexing:
+            with timer("summary"):
+                summary.update(get_spectrogram_summary(ff + iq.center, zz))
+
+        if inline_png:
+            with timer("png_render"):
+                outputs.append(render_spectrogram(ff, tt, zz, iq.center, filename, settings))
     if "spectrum" in todo:
-        ff, pp, _ = iq.get_fft()
-        np.savez(output_dir + filename + "_spectrum.npz", arr_0=ff + iq.center, arr_1=pp)
-
-        if "png" in todo:
-            plot_spectrum(
-                ff,
-                pp,
-                cen=iq.center,
-                span=None,
-                dbm=dbm,
-                filename=output_dir + filename + '_spectrum',
-                title=filename,
+        if shared_spectrum:
+            with timer("average"):
+                pp = get_integrated_spectrum(zz)
+        else:
+            if streaming:
+                # The full length FFT needs all samples at once
+                with timer("read"):
+                    iq.read(nframes=nframes, lframes=lframes)
+            with timer("fft"):
+                ff, pp, _ = iq.get_fft()
+        with timer("npz_write"):
+            save_spectrum(
+                output_dir + filename + "_spectrum.npz", ff + iq.center, pp, **output_format
+            )
+        outputs.append(filename + "_spectrum.npz")
+        if indexing:
+            with timer("summary"):
+                summary.update(get_spectrum_summary(ff + iq.center, pp))
+
+        if inline_png:
+            with timer("png_render"):
+                outputs.append(render_spectrum(ff, pp, iq.center, filename, settings))
+
+    for profile, profile_sizes in zip(profiles, sizes):
+        outputs.extend(
+            process_profile(
+                iq,
+                samples,
+                filename,
+                profile,
+                profile_sizes,
+                settings,
+                output_format,
+                inline_png,
+                timer,
             )
+        )
 
     end_time = time.time()  # Record end time
     elapsed_time = end_time - start_time  # Calculate elapsed time
     logger.info(f"Finished processing {filename} in {elapsed_time:.2f} seconds.")
+    return {
+        "duration": round(elapsed_time, 3),
+        "outputs": outputs,
+        "center": float(iq.center),
+        "nframes": nframes,
+        "lframes": lframes,
+        "summary": summary,
+        "metrics": {
+            "stages": timer.result(),
+            "bytes": os.path.getsize(monitor_dir + filename),
+            "worker": os.getpid(),
+            "max_rss": get_max_rss(),
+        },
+    }
+
+
+# Let the main process handle Ctrl+C, workers finish their current file
+def init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# PNG rendering in its own pool, fed with files whose NPZ results are saved
+class RenderStage:
+    def __init__(self, settings, distribution=None):
+        self.settings = settings
+        self.distribution = distribution
+        self.output_dir = settings["paths"]["output_dir"]
+        self.workers = settings["processing"].get("render_workers", 0)
+        self.policy = settings["processing"].get("render_policy", "drop")
+        queue_size = 1 if self.policy == "latest" else settings["processing"].get(
+            "render_queue", 20
+        )
+        self.pending = collections.deque(maxlen=queue_size)
+        self.in_flight = {}
+        self.pool = None
+        if self.workers > 0 and "png" in settings["analysis"]["todo"]:
+            self.pool = multiprocessing.Pool(self.workers, initializer=init_worker)
+
+    def submit(self, filename, center):
+        """
+        Queue a file for rendering, the oldest waiting file is dropped when
+        the queue is full. With the "latest" policy only the newest waits.
+        """
+        if self.pool is None:
+            return
+        if len(self.pending) == self.pending.maxlen:
+            logger.warning(f"Render backlog, skipping PNG of {self.pending[0][0]}.")
+        self.pending.append((filename, center))
+
+    def pump(self):
+        for file, result in list(self.in_flight.items()):
+            if result.ready():
+                del self.in_flight[file]
+                try:
+                    outputs = result.get()
+                except Exception as e:
+                    logger.error(f"Error rendering file {file}: {e}")
+                    continue
+                if self.distribution is not None:
+                    self.distribution.submit(
+                        [os.path.join(self.output_dir, output) for output in outputs]
+                    )
+        while self.pending and len(self.in_flight) < self.workers:
+            filename, center = self.pending.popleft()
+            self.in_flight[filename] = self.pool.apply_async(
+                render_file, (filename, center, self.settings)
+            )
+
+    def close(self):
+        if self.pool is None:
+            return
+        if self.pending:
+            logger.warning(f"Not rendering {len(self.pending)} queued PNGs.")
+            self.pending.clear()
+        self.pool.close()
+        self.pool.join()
+        self.pump()
+
+
+# Record finished jobs in the journal as each one is done
+def collect_finished(
+    in_flight,
+    journal,
+    monitor_dir,
+    render_stage,
+    index=None,
+    metrics=None,
+    claims=None,
+    distribution=None,
+    failed=None,
+):
+    for file, result in list(in_flight.items()):
+        if not result.ready():
+            continue
+        del in_flight[file]
+        try:
+            info = result.get()
+        except Exception as e:
+            logger.error(f"Error processing file {file}: {e}")
+            info = {"error": str(e)}
+        summary = info.pop("summary", None)
+        if metrics is not None:
+            metrics.record(file, info.pop("metrics", {}), info.get("error"))
+        else:
+            info.pop("metrics", None)
+        if index is not None and summary:
+            index.add(file, info["center"], summary)
+        try:
+            st = os.stat(os.path.join(monitor_dir, file))
+            info.update(size=st.st_size, mtime=st.st_mtime)
+        except OSError:
+            pass
+        journal.record(file, **info)
+        if "error" in info:
+            # Tried again at the next start, not by this run
+            if failed is not None:
+                failed.add(file)
+            if claims is not None:
+                claims.give_up(file)
+        else:
+            if claims is not None:
+                claims.release(file)
+            render_stage.submit(file, info["center"])
+            if distribution is not None:
+                output_dir = render_stage.output_dir
+                distribution.submit(
+                    [os.path.join(monitor_dir, file)]
+                    + [os.path.join(output_dir, output) for output in info["outputs"]]
+                )
 
 
 # Monitor and process files
 def monitor_directory(settings):
-    global PROCESSED_FILES
-
     state_file = settings["paths"]["state_file"]
     monitor_dir = settings["paths"]["monitor_dir"]
     num_cores = settings["processing"]["num_cores"]
     interval_seconds = settings["processing"]["interval_seconds"]
 
-    load_processed_files(state_file)  # Load state at startup
+    journal = ProcessedJournal(state_file)  # Load state at startup
+
+    fft_threads = settings["processing"].get("fft_threads", 1)
+    if num_cores * fft_threads > multiprocessing.cpu_count():
+        logger.warning(
+            f"{num_cores} workers with {fft_threads} FFT threads each "
+            f"oversubscribe the {multiprocessing.cpu_count()} available cores."
+        )
+
+    analysis = settings["analysis"]
+    if (
+        analysis["nframes"] == "auto"
+        and "spectrum" in analysis["todo"]
+        and analysis.get("spectrum_mode", "fft") == "fft"
+    ):
+        logger.warning(
+            'nframes = "auto" with spectrum_mode = "fft" reads whole files into memory '
+            'for the spectrum, use spectrum_mode = "spectrogram" for long captures.'
+        )
+
+    # One long-lived pool, files are dispatched as soon as they are ready
+    pool = multiprocessing.Pool(num_cores, initializer=init_worker)
+    in_flight = {}
+    watcher = make_watcher(settings)
+    # Copies to further destinations run in I/O threads of this process
+    distribution = DistributionStage(settings)
+    render_stage = RenderStage(settings, distribution)
+    index_file = settings["paths"].get("index_file")
+    index = SpectraIndex(index_file) if index_file is not None else None
+    metrics = LooperMetrics(
+        settings["paths"].get("metrics_file"),
+        settings["processing"].get("metrics_port", 0),
+    )
+
+    # Only as many files as workers go to the pool, the rest waits here in order
+    max_age_minutes = settings["processing"].get("max_age_minutes", 0)
+    scheduler = FileScheduler(
+        monitor_dir, settings["processing"].get("schedule", "newest"), max_age_minutes
+    )
+
+    # Several instances on one directory share the work through lease files
+    claims_dir = settings["paths"].get("claims_dir")
+    claims = None
+    if claims_dir is not None:
+        claims = WorkClaims(
+            claims_dir,
+            settings["processing"].get("lease_seconds", 120),
+            settings["processing"].get("node_name"),
+        )
+        logger.info(f"Sharing work through {claims_dir} as {claims.owner}.")
+
+    failed = set()  # files that failed in this run
+
+    def is_known(file):
+        return (
+            file in journal
+            or file in failed
+            or file in in_flight
+            or file in scheduler
+            or (claims is not None and file in claims.held)
+        )
+
+    def schedule(files):
+        for file in scheduler.add(files):
+            logger.info(f"Skipping {file}, older than {max_age_minutes} minutes.")
+            journal.record(file, skipped=f"older than {max_age_minutes} minutes")
+
     try:
         while True:
-            files = [f for f in os.listdir(monitor_dir) if f.lower().endswith(".tiq")]
-            unprocessed_files = [f for f in files if f not in PROCESSED_FILES]
-
-            # Check for files that are ready to process
-            ready_files = []
-            for file in unprocessed_files:
-                filepath = os.path.join(monitor_dir, file)
-                if os.path.isfile(filepath) and is_file_ready(filepath, settings):
-                    ready_files.append(file)
+            # Wait for files that are ready to process
+            ready_files = watcher.poll(interval_seconds, is_known)
 
             if ready_files:
                 logger.info(f"Files to process: {ready_files}")
+                schedule(ready_files)
 
-                # Prepare the partial function with the additional argument
-                process_file_partial = partial(process_file, settings=settings)
-
-                # Process files using multiprocessing pool
-                with multiprocessing.Pool(num_cores) as pool:
-                    pool.map(process_file_partial, ready_files)
+            # Journal the processed files as each one finishes
+            collect_finished(
+                in_flight,
+                journal,
+                monitor_dir,
+                render_stage,
+                index,
+                metrics,
+                claims,
+                distribution,
+                failed,
+            )
 
-                # Update the list of processed files
-                PROCESSED_FILES.update(ready_files)
+            if claims is not None:
+                done, free = claims.maintain(in_flight)
+                for file, owner in done:
+                    journal.record(file, processed_by=owner)
+                if free:
+                    logger.info(f"Leases given up or expired: {free}")
+                    schedule(free)
 
-                # Save state after processing files
-                save_processed_files(state_file)
+            # Hand the next files to the workers that are free
+            while scheduler and len(in_flight) < num_cores:
+                file = scheduler.pop()
+                if claims is not None and not claims.claim(file):
+                    continue  # Another instance has it
+                in_flight[file] = pool.apply_async(process_file, (file, settings))
 
-            time.sleep(interval_seconds)  # Monitor at regular intervals
+            render_stage.pump()
+            distribution.pump()
+            metrics.set_queue_depth(len(in_flight) + len(scheduler), len(render_stage.pending))
     except KeyboardInterrupt:
         logger.info("Shutting down gracefully...")
-        save_processed_files(state_file)  # Save state on exit
+        if scheduler:
+            logger.info(f"{len(scheduler)} queued files are left for the next start.")
+        watcher.close()
+        pool.close()
+        pool.join()  # Let the files in flight finish
+        collect_finished(
+            in_flight,
+            journal,
+            monitor_dir,
+            render_stage,
+            index,
+            metrics,
+            claims,
+            distribution,
+            failed,
+        )
+        render_stage.close()
+        distribution.close()  # Lets the copies in progress finish
+        journal.close()
+        if index is not None:
+            index.close()
+        metrics.close()  # Prints the summary of the run
 
 
 def main():
@@ -0,0 +1,199 @@
+#
+# Stage timings and throughput of the looper, as JSON lines and over HTTP
+#
+
+import json
+import time
+import resource
+import threading
+import contextlib
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from loguru import logger
+
+
+class StageTimer:
+    """
+    Wall time summed per stage name.
+    """
+
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+
+    @contextlib.contextmanager
+    def __call__(self, stage):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.perf_counter() - start_time
+
+    def result(self):
+        return {stage: round(seconds, 6) for stage, seconds in self.seconds.items()}
+
+
+def get_max_rss():
+    """
+    Memory high-water mark of this process in bytes.
+    """
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class LooperMetrics:
+    """
+    Collects the metrics the workers return with each file in the main
+    process. Every file is written as one JSON line to metrics_file, the
+    totals are served in the Prometheus text format on metrics_port of
+    localhost and summarized at shutdown.
+    """
+
+    RATE_WINDOW = 60  # seconds for the recent files/s and bytes/s
+
+    def __init__(self, metrics_file=None, metrics_port=0):
+        self.start_time = time.monotonic()
+        self.lock = threading.Lock()
+        self.files = 0
+        self.failed = 0
+        self.bytes = 0
+        self.stage_seconds = collections.defaultdict(float)
+        self.worker_max_rss = {}
+        self.queue_depth = 0
+        self.render_queue_depth = 0
+        self.recent = collections.deque()  # (time, bytes) of recent files
+
+        self.file = open(metrics_file, "a") if metrics_file else None
+        self.server = None
+        if metrics_port:
+            self.start_server(metrics_port)
+
+    def start_server(self, port):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # no access log in the looper log
+
+        try:
+            self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        except OSError as e:
+            logger.warning(f"Could not serve metrics on port {port}: {e}")
+            return
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+
+    def set_queue_depth(self, in_flight, render_pending):
+        with self.lock:
+            self.queue_depth = in_flight
+            self.render_queue_depth = render_pending
+
+    def get_rates(self, now):
+        """
+        Files/s and bytes/s over the last RATE_WINDOW seconds.
+        """
+        while self.recent and now - self.recent[0][0] > self.RATE_WINDOW:
+            self.recent.popleft()
+        window = min(self.RATE_WINDOW, max(now - self.start_time, 1e-9))
+        return len(self.recent) / window, sum(b for _, b in self.recent) / window
+
+    def record(self, file, metrics, error=None):
+        """
+        Account one finished file, metrics as returned by process_file.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.files += 1
+            if error is not None:
+                self.failed += 1
+            size = metrics.get("bytes", 0)
+            self.bytes += size
+            self.recent.append((now, size))
+            for stage, seconds in metrics.get("stages", {}).items():
+                self.stage_seconds[stage] += seconds
+            worker = metrics.get("worker")
+            if worker is not None:
+                self.worker_max_rss[worker] = max(
+                    self.worker_max_rss.get(worker, 0), metrics.get("max_rss", 0)
+                )
+            files_per_second, bytes_per_second = self.get_rates(now)
+            record = dict(
+                time=time.time(),
+                file=file,
+                error=error,
+                queue_depth=self.queue_depth,
+                render_queue_depth=self.render_queue_depth,
+                files_per_second=round(files_per_second, 3),
+                bytes_per_second=round(bytes_per_second, 1),
+                **metrics,
+            )
+        if self.file is not None:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+
+    def render(self):
+        """
+        Metrics in the Prometheus text exposition format.
+        """
+        with self.lock:
+            files_per_second, bytes_per_second = self.get_rates(time.monotonic())
+            lines = [
+                "# TYPE looper_files_total counter",
+                f"looper_files_total {self.files}",
+                "# TYPE looper_files_failed_total counter",
+                f"looper_files_failed_total {self.failed}",
+                "# TYPE looper_bytes_total counter",
+                f"looper_bytes_total {self.bytes}",
+                "# TYPE looper_queue_depth gauge",
+                f"looper_queue_depth {self.queue_depth}",
+                "# TYPE looper_render_queue_depth gauge",
+                f"looper_render_queue_depth {self.render_queue_depth}",
+                "# TYPE looper_files_per_second gauge",
+                f"looper_files_per_second {files_per_second:.6g}",
+                "# TYPE looper_bytes_per_second gauge",
+                f"looper_bytes_per_second {bytes_per_second:.6g}",
+                "# TYPE looper_stage_seconds_total counter",
+            ]
+            for stage, seconds in sorted(self.stage_seconds.items()):
+                lines.append(f'looper_stage_seconds_total{{stage="{stage}"}} {seconds:.6f}')
+            lines.append("# TYPE looper_worker_max_rss_bytes gauge")
+            for worker, max_rss in sorted(self.worker_max_rss.items()):
+                lines.append(f'looper_worker_max_rss_bytes{{worker="{worker}"}} {max_rss}')
+        return "\n".join(lines) + "\n"
+
+    def log_summary(self):
+        elapsed = time.monotonic() - self.start_time
+        with self.lock:
+            logger.info(
+                f"Processed {self.files} files ({self.failed} failed, "
+                f"{self.bytes / 1e6:.1f} MB) in {elapsed:.1f} s, "
+                f"{self.files / elapsed:.2f} files/s, {self.bytes / 1e6 / elapsed:.2f} MB/s."
+            )
+            total = sum(self.stage_seconds.values())
+            for stage, seconds in sorted(self.stage_seconds.items(), key=lambda s: -s[1]):
+                logger.info(
+                    f"  {stage}: {seconds:.2f} s, {seconds / max(self.files, 1):.3f} s per file "
+                    f"({100 * seconds / total if total else 0:.0f} %)"
+                )
+            if self.worker_max_rss:
+                logger.info(
+                    f"  worker memory high-water mark: {max(self.worker_max_rss.values()) / 1e6:.0f} MB"
+                )
+
+    def close(self):
+        self.log_summary()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.file is not None:
+            self.file.close()
@@ -3,7 +3,14 @@ import numpy as np
 from loguru import logger
 from tqdm import tqdm
 import sys
+import os
+import json
+import collections
+import multiprocessing
 from iqtools import *
+from fast_render import render_spectrogram_png
+from npz_format import load_spectrogram, save_spectrogram, save_spectrum
+from spectra_index import SpectraIndex, source_name
 import sys
 
 # font settings for plot
@@ -11,14 +18,204 @@ font = {"weight": "bold", "size": 6}  #'family' : 'normal',
 plt.rc("font", **font)
 
 
-def process_files(args):
+def find_peak(proj_spc, window=None, center=None, subbin=False):
+    """
+    Power and position of the strongest bin of a projected spectrum. With
+    window and center, only center +- window bins are searched. With subbin,
+    the position is refined by a parabola through the peak and its neighbours.
+    """
+    lo, hi = 0, len(proj_spc)
+    if window is not None and center is not None:
+        lo = max(0, int(round(center)) - window)
+        hi = min(len(proj_spc), int(round(center)) + window + 1)
+    max_bin = lo + np.argmax(proj_spc[lo:hi])
+    max_pwr = proj_spc[max_bin]
+
+    if not subbin or max_bin == 0 or max_bin == len(proj_spc) - 1:
+        return max_pwr, max_bin
+    left, right = proj_spc[max_bin - 1], proj_spc[max_bin + 1]
+    curvature = left - 2 * max_pwr + right
+    if curvature == 0:
+        return max_pwr, max_bin
+    return max_pwr, max_bin + 0.5 * (left - right) / curvature
+
+
+def add_shifted(zz_sum, zz, shift):
+    """
+    Add zz shifted by -shift bins along the frequency axis into zz_sum in
+    place, wrapping around like np.roll. The integer part of the shift is
+    done by slicing, a fractional part with a phase ramp in the Fourier
+    domain of each row.
+    """
+    ncols = np.shape(zz)[1]
+    whole = int(np.floor(shift))
+    fraction = shift - whole
+    if fraction:
+        k = np.fft.rfftfreq(ncols)
+        zz = np.fft.irfft(
+            np.fft.rfft(zz, axis=1) * np.exp(2j * np.pi * k * fraction), n=ncols, axis=1
+        )
+    whole %= ncols
+    zz_sum[:, : ncols - whole] += zz[:, whole:]
+    zz_sum[:, ncols - whole :] += zz[:, :whole]
+
+
+def prepare_file(file, args, ref_pos):
+    """
+    Load one spectrogram, apply the power limit and find its shift towards
+    ref_pos. Returns the axes, the array to add (None if skipped), the shift
+    in bins, the peak position and a message for verbose mode.
+    """
+    ff, tt, zz = load_spectrogram(file)
+
+    # Read time cut parameters
+    if args.time_cut is not None:
+        y_idx = (np.abs(tt - float(args.time_cut))).argmin()
+    else:
+        y_idx = 0
+
+    # Apply slice for tracking
+    sly = slice(y_idx, len(tt)) # this one was very tricky until I found it!
+
+    # Project sliced spectrogram and find maximum, around the reference if known
+    proj_spc = np.sum(zz[sly,:], axis=0)
+    max_pwr, max_pos = find_peak(
+        proj_spc, window=args.peak_window, center=ref_pos, subbin=args.subbin
+    )
+
+    # The limit applies to the whole projection like in the index, the window only locates the peak
+    if args.pwr_limit is not None:
+        if np.max(proj_spc) < args.pwr_limit:
+            return ff, tt, None, 0, max_pos, "Skipping file, too low power!"
+
+    shift = 0
+    message = None
+    # If shift tracking
+    if args.shift_track and ref_pos is not None:
+        shift = max_pos - ref_pos
+        message = f"Ref. pos: {ref_pos} \tCurr. pos: {max_pos} \tCurr. pwr: {max_pwr:.1f} \tShift: {shift}"
+
+    return ff, tt, zz, shift, max_pos, message
+
+
+def sum_chunk(files, args, ref_pos, shape):
+    """
+    Sum a chunk of consecutive files in order. Runs in the worker processes.
+    Files whose spectrogram does not have the shape of the sum are left out.
+    """
+    zz_sum = None
+    axes = None
+    covered = []
+    messages = []
+    for file in files:
+        try:
+            ff, tt, zz, shift, _, message = prepare_file(file, args, ref_pos)
+            if zz is not None and np.shape(zz) != tuple(shape):
+                raise ValueError(f"shape {np.shape(zz)} does not match {tuple(shape)} of the sum")
+        except Exception as e:
+            messages.append(("error", f"Error processing file {file}: {e}"))
+            continue
+        covered.append(file)
+        axes = (ff, tt)
+        if message is not None and args.verbose is True:
+            messages.append(("info", message))
+        if zz is None:
+            continue
+        if zz_sum is None:
+            zz_sum = np.zeros_like(zz, dtype=np.float64)
+        # Apply shift
+        add_shifted(zz_sum, zz, shift)
+    return zz_sum, axes, covered, messages
+
+
+def add_partial_sum(stack, zz_partial):
+    """
+    Pairwise reduction of the chunk sums in file order. The stack holds at
+    most log2(number of chunks) arrays, and the order of the additions only
+    depends on the chunk size, not on the number of jobs.
+    """
+    level = 0
+    while stack and stack[-1][0] == level:
+        _, zz_left = stack.pop()
+        zz_left += zz_partial
+        zz_partial = zz_left
+        level += 1
+    stack.append((level, zz_partial))
+
+
+def get_options(args):
+    # Options that change the sum, an accumulator is only valid for the same ones
+    return json.dumps(
+        {
+            "time_cut": args.time_cut,
+            "shift_track": args.shift_track,
+            "pwr_limit": args.pwr_limit,
+            "peak_window": args.peak_window,
+            "subbin": args.subbin,
+        },
+        sort_keys=True,
+    )
+
+
+def load_accumulator(filename, args):
+    """
+    Running sum of earlier runs, an empty one if there is none or it was
+    made with different options.
+    """
+    accumulator = {"zz_sum": None, "ff": None, "tt": None, "ref_pos": None, "files": []}
+    if not os.path.isfile(filename):
+        return accumulator
+    with np.load(filename) as data:
+        if str(data["options"]) != get_options(args):
+            logger.warning(f"Accumulator {filename} was made with other options, starting from scratch.")
+            return accumulator
+        ref_pos = float(data["ref_pos"])
+        accumulator.update(
+            zz_sum=data["zz_sum"],
+            ff=data["ff"],
+            tt=data["tt"],
+            ref_pos=None if np.isnan(ref_pos) else ref_pos,
+            files=list(data["files"]),
+        )
+    logger.info(f"Accumulator holds {len(accumulator['files'])} files.")
+    return accumulator
+
+
+def save_accumulator(filename, accumulator, args):
+    ref_pos = accumulator["ref_pos"]
+    # Replace atomically, an interrupted save must not lose the running sum
+    tmp_file = filename + ".tmp.npz"
+    np.savez(
+        tmp_file,
+        zz_sum=accumulator["zz_sum"],
+        ff=accumulator["ff"],
+        tt=accumulator["tt"],
+        ref_pos=np.nan if ref_pos is None else ref_pos,
+        files=np.array(accumulator["files"], dtype=str),
+        options=get_options(args),
+    )
+    os.replace(tmp_file, filename)
+    logger.info(f"Accumulator with {len(accumulator['files'])} files saved to {filename}.")
+
+
+def process_files(args, accumulator=None):
     """
     Process the files from the file list, determine and apply shifts,
     then summming up the 'zz' arrays from spectrogram files.
+
+    Chunks of files are summed in parallel by args.jobs processes and the
+    chunk sums are reduced pairwise, so the result is bit for bit the same
+    for any number of jobs with the same chunk size. Other chunk sizes, and
+    the plain running sum of older versions, add in another order and can
+    differ by floating point rounding in the last digits.
+
+    With an accumulator from load_accumulator, only files it does not hold
+    yet are summed, and it is updated with them.
     """
-    zz_sum = None
+    ff, tt = None, None
     found_files = False
     ref_pos = None
+    covered = []
 
     file_list = args.file_list
 
@@ -27,63 +224,107 @@ def process_files(args):
 
     spectrogram_files = [file for file in files if file.endswith("_spectrogram.npz")]
 
-    if not spectrogram_files:
+    if accumulator is not None and accumulator["files"]:
+        included = set(accumulator["files"])
+        spectrogram_files = [file for file in spectrogram_files if file not in included]
+        ff, tt, ref_pos = accumulator["ff"], accumulator["tt"], accumulator["ref_pos"]
+        found_files = True
+        logger.info(f"{len(spectrogram_files)} new files to add.")
+
+    if not spectrogram_files and not found_files:
         logger.info(
             "No files ending with '_spectrogram.npz' found. Exiting gracefully."
         )
-        return zz_sum, False
+        return ff, tt, None, False
 
-    # Go over files
-    for file in tqdm(spectrogram_files, desc="Processing files"):
-        try:
-            data = np.load(file)
-            xx, yy, zz = data["arr_0"], data["arr_1"], data["arr_2"]
+    # Skip files below the power limit using the looper index, without loading them
+    if args.index is not None and args.pwr_limit is not None:
+        if args.time_cut is not None:
+            logger.info("Index holds the power without time cut, not using it.")
+        else:
+            index = SpectraIndex(args.index)
+            rows = index.lookup(spectrogram_files)
+            index.close()
+            spectrogram_files = [
+                file for file in spectrogram_files
+                if source_name(file) not in rows
+                or rows[source_name(file)]["max_power"] is None
+                or rows[source_name(file)]["max_power"] >= args.pwr_limit
+            ]
+            logger.info(f"{len(spectrogram_files)} files left after index power check.")
 
-            found_files = True
+    # The shape of the sum and the reference position for shift tracking
+    # are those of the first accepted file, unless the accumulator has them
+    shape = None
+    if accumulator is not None and accumulator["zz_sum"] is not None:
+        shape = np.shape(accumulator["zz_sum"])
+    if shape is None or (args.shift_track and ref_pos is None):
+        for file in spectrogram_files:
+            try:
+                _, _, zz, _, max_pos, _ = prepare_file(file, args, None)
+            except Exception:
+                continue
+            if zz is not None:
+                if shape is None:
+                    shape = np.shape(zz)
+                if args.shift_track and ref_pos is None:
+                    ref_pos = max_pos
+                break
 
-            # Read time cut parameters
-            if args.time_cut is not None:
-                y_idx = (np.abs(yy[:,0] - float(args.time_cut))).argmin()
-            else:
-                y_idx = 0
-            
-            # Apply slice for tracking
-            sly = slice(y_idx, np.shape(yy)[0]) # this one was very tricky until I found it!
+    chunk_size = max(1, args.chunk_size)
+    chunks = [
+        spectrogram_files[i : i + chunk_size]
+        for i in range(0, len(spectrogram_files), chunk_size)
+    ]
 
-            # Project sliced spectrogram and find maximum
-            proj_spc = np.sum(zz[sly,:], axis=0)
-            max_pwr=np.max(proj_spc)
-            max_bin=np.argmax(proj_spc)
-            
-            if args.pwr_limit is not None:
-                if max_pwr < args.pwr_limit:
-                    if args.verbose is True:
-                        tqdm.write("Skipping file, too low power!")
-                    continue
-           
-            # If shift tracking
-            if args.shift_track:
-                # determine shift
-                if ref_pos is None:
-                    ref_pos = max_bin
-                    shift = 0
-                else:
-                    shift = max_bin - ref_pos
-
-                if args.verbose is True:
-                    tqdm.write(f"Ref. pos: {ref_pos} \tCurr. pos: {max_bin} \tCurr. pwr: {max_pwr:.1f} \tShift: {shift}")
-
-                # Apply shift
-                    zz=np.roll(zz, shift=-shift, axis=1)
-
-            if zz_sum is None:
-                zz_sum = zz
+    stack = []
+    progress = tqdm(total=len(spectrogram_files), desc="Processing files")
+
+    def consume(chunk, result):
+        nonlocal ff, tt, found_files
+        zz_partial, axes, chunk_covered, messages = result
+        for level, message in messages:
+            if level == "error":
+                logger.error(message)
             else:
-                zz_sum += zz
-        except Exception as e:
-            logger.error(f"Error processing file {file}: {e}")
+                tqdm.write(message)
+        if chunk_covered:
+            found_files = True
+            ff, tt = axes
+            covered.extend(chunk_covered)
+        if zz_partial is not None:
+            add_partial_sum(stack, zz_partial)
+        progress.update(len(chunk))
+
+    if args.jobs > 1:
+        with multiprocessing.Pool(args.jobs) as pool:
+            # Only a bounded number of chunk sums wait in memory
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append((chunk, pool.apply_async(sum_chunk, (chunk, args, ref_pos, shape))))
+                if len(pending) >= 2 * args.jobs:
+                    chunk, result = pending.popleft()
+                    consume(chunk, result.get())
+            while pending:
+                chunk, result = pending.popleft()
+                consume(chunk, result.get())
+    else:
+        for chunk in chunks:
+            consume(chunk, sum_chunk(chunk, args, ref_pos, shape))
+    progress.close()
+
+    zz_sum = None if accumulator is None else accumulator["zz_sum"]
+    for _, zz_partial in stack:
+        if zz_sum is None:
+            zz_sum = zz_partial
+        else:
+            zz_sum += zz_partial
+
+    if accumulator is not None:
+        accumulator.update(zz_sum=zz_sum, ff=ff, tt=tt, ref_pos=ref_pos)
+        accumulator["files"].extend(covered)
 
-    return xx, yy, zz_sum, found_files
+    return ff, tt, zz_sum, found_files
 
 
 def main():
@@ -103,8 +344,24 @@ def main():
    
     parser.add_argument("-s", "--shift-track", action='store_true', required=False, help="Enable shift tracking based on strongest peak in spectrum (optional)")
     
+    parser.add_argument("-w", "--peak-window", type=int, required=False, help="Only search the peak within this many bins around the reference peak (optional)")
+
+    parser.add_argument("-u", "--subbin", action='store_true', required=False, help="Track and apply shifts with sub-bin precision (optional)")
+
     parser.add_argument("-l", "--pwr-limit", type=float, required=False, help="Set minimum power required to process file (optional)")
     
+    parser.add_argument("-f", "--fast-render", action='store_true', required=False, help="Write the summed spectrogram PNG without matplotlib axes, much faster (optional)")
+
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of processes summing files in parallel (default: 1)")
+
+    parser.add_argument("-c", "--chunk-size", type=int, default=16, help="Files summed per job, results are bit for bit the same for any --jobs with the same chunk size, other chunk sizes can differ by rounding in the last digits (default: 16)")
+
+    parser.add_argument("-k", "--compact", action='store_true', required=False, help="Write the summed NPZ files in the compact layout with 1D axes instead of arr_0, arr_1, arr_2 (optional)")
+
+    parser.add_argument("-a", "--accumulator", type=str, required=False, help="Keep the running sum in this file and only add files not summed yet (optional)")
+
+    parser.add_argument("-i", "--index", type=str, required=False, help="Looper index file to apply the power limit without loading files (optional)")
+
     parser.add_argument("-v", "--verbose", action='store_true', required=False, help="Print additional information (optional)")
 
     args = parser.parse_args()
@@ -120,37 +377,54 @@ def main():
             logger.info("Verbose mode enabled!")
 
         logger.info("Starting the summation...")
-        xx, yy, zz_sum, found_files = process_files(args)
+        accumulator = None
+        if args.accumulator is not None:
+            accumulator = load_accumulator(args.accumulator, args)
+        ff, tt, zz_sum, found_files = process_files(args, accumulator)
+        if accumulator is not None and accumulator["zz_sum"] is not None:
+            save_accumulator(args.accumulator, accumulator, args)
+        if zz_sum is None:
+            logger.info("No valid spectrogram files found to process.")
+            return
 
         if args.time_cut is not None:
-            y_idx = (np.abs(yy[:,0] - float(args.time_cut))).argmin()
+            y_idx = (np.abs(tt - float(args.time_cut))).argmin()
             filename_suffix = "_time_cut"
         else:
             y_idx = 0
             filename_suffix = ""
             
         logger.info("Saving 3D NPZ sum to file...")
-        np.savez(f"summed_spectrogram{filename_suffix}.npz", arr_0=xx[y_idx:,:], arr_1=yy[y_idx:,:], arr_2=zz_sum[y_idx:,:])
+        save_spectrogram(f"summed_spectrogram{filename_suffix}.npz", ff, tt[y_idx:], zz_sum[y_idx:,:], dtype="float64", legacy=not args.compact)
         
         logger.info("Plotting the 3D NPZ sum...")
         
-        slx = slice(int(np.shape(xx[y_idx:,:])[1]/2) - 500, int(np.shape(xx[y_idx:,:])[1]/2) + 500)
-        sly = slice(y_idx, np.shape(yy)[0]) # this one was very tricky until I found it!
+        slx = slice(int(len(ff)/2) - 500, int(len(ff)/2) + 500)
+        sly = slice(y_idx, len(tt)) # this one was very tricky until I found it!
+        xx, yy = np.meshgrid(ff, tt)
         
-        plot_spectrogram(
-            xx[sly,slx], yy[sly,slx], zz_sum[sly,slx],
-            zzmin=10,
-            zzmax=5000,
-            filename=f"summed_spectrogram{filename_suffix}",
-            title=f"summed_spectrogram{filename_suffix}",
-        )
+        if args.fast_render:
+            render_spectrogram_png(
+                zz_sum[sly,slx],
+                f"summed_spectrogram{filename_suffix}.png",
+                zzmin=10,
+                zzmax=5000,
+            )
+        else:
+            plot_spectrogram(
+                xx[sly,slx], yy[sly,slx], zz_sum[sly,slx],
+                zzmin=10,
+                zzmax=5000,
+                filename=f"summed_spectrogram{filename_suffix}",
+                title=f"summed_spectrogram{filename_suffix}",
+            )
 
         logger.info("Creating 2D average...")
         navg = np.shape(zz_sum[y_idx:,:])[0]
         xx_avg, yy_avg, zz_sum_avg = get_averaged_spectrogram(xx[y_idx:,:], yy[y_idx:,:], zz_sum[y_idx:,:], every=navg)
 
         logger.info("Saving 2D NPZ sum to file...")
-        np.savez(f"summed_spectrum{filename_suffix}.npz", arr_0=xx_avg.flatten(), arr_1=zz_sum_avg.flatten())
+        save_spectrum(f"summed_spectrum{filename_suffix}.npz", xx_avg.flatten(), zz_sum_avg.flatten(), dtype="float64", legacy=not args.compact)
 
         logger.info("Plotting the 2D NPZ sum...")
         plot_spectrum(
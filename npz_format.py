@@ -0,0 +1,226 @@
+#
+# Reading and writing of the spectrogram and spectrum NPZ files
+#
+# Layout version 1 (legacy, no version member):
+#   spectrogram: arr_0, arr_1, arr_2 = 2D frequency mesh, 2D time mesh, 2D power
+#   spectrum:    arr_0, arr_1 = 1D frequency, 1D power
+#
+# Layout version 2 (compact):
+#   version = 2
+#   ff, tt: 1D frequency (absolute, Hz) and time (s) axes
+#   zz or pp: 2D or 1D power, float64, float32 or log-uint16
+#   with log-uint16, zz_log_min and zz_log_max give the range of log10(zz)
+#   envelope spectra (npz_reducer.py): pp_min and pp_max instead of pp
+#
+
+import struct
+import zipfile
+import numpy as np
+
+FORMAT_VERSION = 2
+DTYPES = ("float64", "float32", "log-uint16")
+
+
+def quantize(zz, dtype):
+    """
+    Members holding zz in the requested dtype.
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown output dtype {dtype}, choose one of {DTYPES}.")
+    if dtype != "log-uint16":
+        return {"zz": np.asarray(zz, dtype=dtype)}
+
+    log_zz = np.log10(np.maximum(zz, np.finfo(np.float64).tiny))
+    log_min, log_max = np.min(log_zz), np.max(log_zz)
+    scale = 65535 / (log_max - log_min) if log_max > log_min else 0
+    return {
+        "zz": np.round((log_zz - log_min) * scale).astype(np.uint16),
+        "zz_log_min": log_min,
+        "zz_log_max": log_max,
+    }
+
+
+def dequantize(data, name="zz"):
+    zz = data[name]
+    if zz.dtype != np.uint16:
+        return zz
+    # The range members are named after zz, or after pp_min / pp_max
+    prefix = "zz" if name in ("zz", "pp") else name
+    log_min, log_max = float(data[f"{prefix}_log_min"]), float(data[f"{prefix}_log_max"])
+    return 10 ** (log_min + zz * ((log_max - log_min) / 65535))
+
+
+def save_spectrogram(filename, ff, tt, zz, dtype="float32", compress=False, legacy=False):
+    """
+    Save a spectrogram with 1D axes. ff are the absolute frequencies.
+    With legacy, the version 1 layout with full meshes is written instead.
+    """
+    savez = np.savez_compressed if compress else np.savez
+    if legacy:
+        xx, yy = np.meshgrid(ff, tt)
+        savez(filename, xx, yy, zz)
+        return
+    savez(filename, version=FORMAT_VERSION, ff=ff, tt=tt, **quantize(zz, dtype))
+
+
+def save_spectrum(filename, ff, pp, dtype="float32", compress=False, legacy=False):
+    """
+    Save a spectrum, ff are the absolute frequencies.
+    """
+    savez = np.savez_compressed if compress else np.savez
+    if legacy:
+        savez(filename, arr_0=ff, arr_1=pp)
+        return
+    members = quantize(pp, dtype)
+    members["pp"] = members.pop("zz")
+    savez(filename, version=FORMAT_VERSION, ff=ff, **members)
+
+
+def save_spectrum_envelope(filename, ff, pp_min, pp_max, dtype="float64", compress=False):
+    """
+    Save the lower and upper envelope of a spectrum, always version 2.
+    """
+    savez = np.savez_compressed if compress else np.savez
+    members = {}
+    for name, pp in (("pp_min", pp_min), ("pp_max", pp_max)):
+        for key, value in quantize(pp, dtype).items():
+            members[key.replace("zz", name)] = value
+    savez(filename, version=FORMAT_VERSION, ff=ff, **members)
+
+
+def get_version(data):
+    return int(data["version"]) if "version" in data.files else 1
+
+
+def load_spectrogram(filename):
+    """
+    Read a spectrogram of any layout, returns the 1D frequency and time
+    axes and the power as float64.
+    """
+    with np.load(filename) as data:
+        if get_version(data) == 1:
+            xx, yy = data["arr_0"], data["arr_1"]
+            ff = xx[0, :] if np.ndim(xx) == 2 else xx
+            tt = yy[:, 0] if np.ndim(yy) == 2 else yy
+            return ff, tt, data["arr_2"]
+        return data["ff"], data["tt"], np.asarray(dequantize(data), dtype=np.float64)
+
+
+def load_spectrum(filename):
+    """
+    Read a spectrum of any layout, returns frequency and power as float64.
+    Of an envelope spectrum, the upper envelope is returned.
+    """
+    with np.load(filename) as data:
+        if get_version(data) == 1:
+            return data["arr_0"], data["arr_1"]
+        name = "pp_max" if is_envelope(data) else "pp"
+        return data["ff"], np.asarray(dequantize(data, name), dtype=np.float64)
+
+
+def is_envelope(data):
+    return "pp_max" in data.files
+
+
+def load_spectrum_envelope(filename):
+    """
+    Read an envelope spectrum, returns frequency, lower and upper envelope.
+    """
+    with np.load(filename) as data:
+        return (
+            data["ff"],
+            np.asarray(dequantize(data, "pp_min"), dtype=np.float64),
+            np.asarray(dequantize(data, "pp_max"), dtype=np.float64),
+        )
+
+
+def map_member(filename, name):
+    """
+    Memory-map one member array of an NPZ file without reading the others.
+    Returns None if the member is compressed and can not be mapped.
+    """
+    with zipfile.ZipFile(filename) as archive:
+        info = archive.getinfo(name + ".npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+
+    with open(filename, "rb") as file:
+        # Skip the local file header of the member, then read the npy header
+        file.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack("<HH", file.read(4))
+        file.seek(name_length + extra_length, 1)
+        version = np.lib.format.read_magic(file)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+        elif version == (2, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+        else:
+            return None
+        offset = file.tell()
+
+    if dtype.hasobject:
+        return None
+    return np.memmap(
+        filename,
+        dtype=dtype,
+        mode="r",
+        offset=offset,
+        shape=shape,
+        order="F" if fortran_order else "C",
+    )
+
+
+def get_peak_frequency(filename):
+    """
+    Frequency of the strongest bin of a spectrum file of any layout. Only the
+    power is read completely, the frequency axis is mapped if possible.
+    """
+    with np.load(filename) as data:
+        if get_version(data) == 1:
+            ff_name, pp_name = "arr_0", "arr_1"
+        else:
+            ff_name, pp_name = "ff", "pp_max" if is_envelope(data) else "pp"
+        # log-uint16 is monotonic in power, no need to dequantize
+        peak = np.argmax(data[pp_name])
+        ff = map_member(filename, ff_name)
+        if ff is None:
+            ff = data[ff_name]
+        return float(ff[peak])
+
+
+def map_spectrogram(filename):
+    """
+    Like load_spectrogram, but the power is memory-mapped when it is stored
+    uncompressed, so it can be worked on in blocks of rows. Returns the 1D
+    axes, the stored power array and a function turning rows of it into
+    float64 power.
+    """
+    with np.load(filename) as data:
+        version = get_version(data)
+        zz_name = "arr_2" if version == 1 else "zz"
+        zz = map_member(filename, zz_name)
+        if zz is None:
+            zz = data[zz_name]
+        if version == 1:
+            # The meshes are as large as zz, only map them for one row and column
+            xx, yy = map_member(filename, "arr_0"), map_member(filename, "arr_1")
+            if xx is None:
+                xx = data["arr_0"]
+            if yy is None:
+                yy = data["arr_1"]
+            ff = np.array(xx[0, :] if np.ndim(xx) == 2 else xx)
+            tt = np.array(yy[:, 0] if np.ndim(yy) == 2 else yy)
+            log_range = None
+        else:
+            ff, tt = data["ff"], data["tt"]
+            log_range = None
+            if zz.dtype == np.uint16:
+                log_range = (float(data["zz_log_min"]), float(data["zz_log_max"]))
+
+    def to_power(rows):
+        if log_range is None:
+            return np.asarray(rows, dtype=np.float64)
+        log_min, log_max = log_range
+        return 10 ** (log_min + rows * ((log_max - log_min) / 65535))
+
+    return ff, tt, zz, to_power
@@ -1,26 +1,157 @@
+import os
 import argparse
+import multiprocessing
 import numpy as np
+from npz_format import (
+    DTYPES,
+    get_version,
+    is_envelope,
+    load_spectrum,
+    load_spectrum_envelope,
+    map_spectrogram,
+    save_spectrogram,
+    save_spectrum,
+    save_spectrum_envelope,
+)
+
+
+def get_block_starts(length, factor):
+    """
+    First bin of every block when combining factor bins into one. A
+    fractional factor gives blocks of alternating integer lengths.
+    """
+    return np.unique(np.floor(np.arange(0, length, factor)).astype(np.intp))
+
+
+def reduce_axis(arr, factor, axis, method="mean", starts=None):
+    """
+    Combine every factor bins along axis into one, by mean, max or min.
+    A shorter last block is kept.
+    """
+    if factor <= 1:
+        return arr
+    if starts is None:
+        starts = get_block_starts(np.shape(arr)[axis], factor)
+    if method == "max":
+        return np.maximum.reduceat(arr, starts, axis=axis)
+    if method == "min":
+        return np.minimum.reduceat(arr, starts, axis=axis)
+    counts = np.diff(np.append(starts, np.shape(arr)[axis]))
+    shape = [1] * np.ndim(arr)
+    shape[axis] = len(counts)
+    return np.add.reduceat(arr, starts, axis=axis) / counts.reshape(shape)
+
+
+def get_output_dtype(stored_dtype):
+    """
+    The output dtype of npz_format that stores the power like stored_dtype.
+    """
+    if stored_dtype == np.uint16:
+        return "log-uint16"
+    return stored_dtype.name if stored_dtype.name in DTYPES else "float64"
+
+
+def reduce_spectrum(filename, args):
+    factor = args.reduce_by
+    reduced_filename = filename + f'_reduced_by_{factor}.npz'
+
+    # The reduced file keeps the layout and dtype of the input
+    with np.load(filename) as data:
+        legacy = get_version(data) == 1
+        envelope = not legacy and is_envelope(data)
+        dtype = "float64" if legacy else get_output_dtype(data["pp_max" if envelope else "pp"].dtype)
+    if envelope:
+        ff, pp_min, pp_max = load_spectrum_envelope(filename)
+    else:
+        ff, pp = load_spectrum(filename)
+        pp_min = pp_max = pp
+
+    # Frequencies are the block centers, the power as requested
+    ff_reduced = reduce_axis(ff, factor, 0, "mean")
+    if args.method == "minmax":
+        # Envelope for plotting, keeps narrow peaks and dips visible
+        save_spectrum_envelope(
+            reduced_filename,
+            ff_reduced,
+            reduce_axis(pp_min, factor, 0, "min"),
+            reduce_axis(pp_max, factor, 0, "max"),
+            dtype=dtype,
+        )
+    else:
+        save_spectrum(
+            reduced_filename,
+            ff_reduced,
+            reduce_axis(pp_max, factor, 0, args.method),
+            dtype=dtype,
+            legacy=legacy,
+        )
+    return reduced_filename
+
+
+def reduce_spectrogram(filename, args):
+    ff, tt, zz, to_power = map_spectrogram(filename)
+    factor = args.reduce_by
+    method = "max" if args.method == "minmax" else args.method
+    time_factor = factor if args.axis in ("time", "both") else 1
+    freq_factor = factor if args.axis in ("frequency", "both") else 1
+    reduced_filename = filename + f'_reduced_by_{factor}.npz'
+
+    # Go through the rows in groups of whole blocks, only one group is in memory at a time
+    nrows = np.shape(zz)[0]
+    starts = get_block_starts(nrows, time_factor) if time_factor > 1 else np.arange(nrows)
+    group = max(1, int(args.block_rows // max(time_factor, 1)))
+    blocks = []
+    for i in range(0, len(starts), group):
+        first = starts[i]
+        last = starts[i + group] if i + group < len(starts) else nrows
+        block = to_power(zz[first:last])
+        if time_factor > 1:
+            block = reduce_axis(block, time_factor, 0, method, starts[i : i + group] - first)
+        blocks.append(reduce_axis(block, freq_factor, 1, method))
+
+    with np.load(filename) as data:
+        legacy = get_version(data) == 1
+    save_spectrogram(
+        reduced_filename,
+        reduce_axis(ff, freq_factor, 0, "mean"),
+        tt[starts],
+        np.concatenate(blocks),
+        dtype="float64" if legacy else get_output_dtype(zz.dtype),
+        legacy=legacy,
+    )
+    return reduced_filename
+
+
+def reduce_file(filename, args):
+    with np.load(filename) as data:
+        if get_version(data) == 1:
+            is_spectrogram = "arr_2" in data.files
+        else:
+            is_spectrogram = "zz" in data.files
+    if is_spectrogram:
+        return reduce_spectrogram(filename, args)
+    return reduce_spectrum(filename, args)
+
 
 def main():
     # Set up argument parser
-    parser = argparse.ArgumentParser(description="Reduce data in a NumPy file")
-    parser.add_argument("input_file", help="Path to the input NumPy file (.npz)")
-    parser.add_argument("--reduce_by", type=float, default=3, help="Factor to reduce the data by (default: 3)")
+    parser = argparse.ArgumentParser(description="Reduce the resolution of spectrum and spectrogram NumPy files")
+    parser.add_argument("input_files", nargs="+", help="Paths to the input NumPy files (.npz)")
+    parser.add_argument("--reduce_by", type=float, default=3, help="Factor to reduce the data by, may be fractional (default: 3)")
+    parser.add_argument("--method", choices=["mean", "max", "minmax"], default="mean", help="Block averaging, max pooling or min/max envelope of spectra (pp_min, pp_max members), max for spectrograms (default: mean)")
+    parser.add_argument("--axis", choices=["frequency", "time", "both"], default="frequency", help="Axes of spectrograms to reduce (default: frequency)")
+    parser.add_argument("--block_rows", type=int, default=256, help="Spectrogram rows read at a time (default: 256)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of files reduced in parallel (default: all cores)")
     args = parser.parse_args()
-    
-    # Load the input file
-    filename = args.input_file
-    data = np.load(filename)
-    ff, pp = data['arr_0'], data['arr_1']
-    
-    # Calculate the reduced length
-    reduce_factor = args.reduce_by
-    reduced_length = int(len(ff) / reduce_factor)
-    
-    # Reduce the data and save to a new file
-    reduced_filename = filename + f'_reduced_by_{reduce_factor}.npz'
-    np.savez(reduced_filename, ff[:reduced_length], pp[:reduced_length])
-    print(f"Reduced data saved to {reduced_filename}")
+
+    # Reduce the data and save to new files
+    with multiprocessing.Pool(max(1, min(args.jobs, len(args.input_files)))) as pool:
+        results = [pool.apply_async(reduce_file, (filename, args)) for filename in args.input_files]
+        for filename, result in zip(args.input_files, results):
+            try:
+                print(f"Reduced data saved to {result.get()}")
+            except Exception as e:
+                print(f"Failed to reduce {filename}: {e}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,172 @@
+#
+# Copying of the raw files and products to further destinations for the looper
+#
+
+import os
+import time
+import errno
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+
+KINDS = ("tiq", "npz", "png")
+
+# copy_file_range and sendfile fail with these if the file systems do not support them
+FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+
+
+def get_kind(path):
+    return os.path.splitext(path)[1].lstrip(".").lower()
+
+
+def copy_data(fd_in, fd_out, size):
+    """
+    Copy size bytes between two file descriptors, inside the kernel with
+    copy_file_range or sendfile where the file systems allow it, otherwise
+    with reads and writes. Each method continues where the last one failed.
+    """
+    offset = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < size:
+                n = os.copy_file_range(fd_in, fd_out, size - offset, offset, offset)
+                if n == 0:
+                    break
+                offset += n
+        except OSError as e:
+            if e.errno not in FALLBACK_ERRNOS:
+                raise
+
+    if offset < size and hasattr(os, "sendfile"):
+        os.lseek(fd_out, offset, os.SEEK_SET)
+        try:
+            while offset < size:
+                n = os.sendfile(fd_out, fd_in, offset, size - offset)
+                if n == 0:
+                    break
+                offset += n
+        except OSError as e:
+            if e.errno not in FALLBACK_ERRNOS:
+                raise
+
+    os.lseek(fd_out, offset, os.SEEK_SET)
+    while offset < size:
+        chunk = os.pread(fd_in, min(1 << 20, size - offset), offset)
+        if not chunk:
+            break
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(fd_out, view) :]
+        offset += len(chunk)
+
+    if offset < size:
+        raise OSError(f"Source ended after {offset} of {size} bytes.")
+
+
+def is_same_file(src_stat, dst):
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        return False
+    return (dst_stat.st_size, dst_stat.st_mtime_ns) == (src_stat.st_size, src_stat.st_mtime_ns)
+
+
+def deliver_file(src, directory, mode="copy"):
+    """
+    Put src into directory, by hard link or copy. The file appears under
+    its final name only when complete: it is written to a temporary name
+    in the destination and renamed atomically. Files that are there with
+    the same size and mtime already are left alone.
+    """
+    os.makedirs(directory, exist_ok=True)
+    dst = os.path.join(directory, os.path.basename(src))
+    src_stat = os.stat(src)
+    if is_same_file(src_stat, dst):
+        return
+    tmp_file = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    try:
+        if mode == "hardlink":
+            try:
+                os.link(src, tmp_file)
+                os.replace(tmp_file, dst)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                    raise
+                # Other file system, copy instead
+
+        with open(src, "rb") as file_in, open(tmp_file, "wb") as file_out:
+            copy_data(file_in.fileno(), file_out.fileno(), src_stat.st_size)
+        os.utime(tmp_file, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+        os.replace(tmp_file, dst)
+    except BaseException:
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        raise
+
+
+class DistributionStage:
+    """
+    Copies or hard links finished files to the destinations of the
+    [distribution] settings with a pool of I/O threads in the main process,
+    so slow network mounts never hold up the processing workers. Failed
+    deliveries are retried with exponential backoff.
+    """
+
+    def __init__(self, settings):
+        distribution = settings.get("distribution", {})
+        self.destinations = distribution.get("destinations", [])
+        self.retries = distribution.get("retries", 5)
+        self.retry_seconds = distribution.get("retry_seconds", 1.0)
+        self.futures = set()
+        self.executor = None
+        if self.destinations:
+            self.executor = ThreadPoolExecutor(
+                distribution.get("threads", 4), thread_name_prefix="distribution"
+            )
+            for destination in self.destinations:
+                logger.info(
+                    f"Distributing {', '.join(destination.get('include', KINDS))} files "
+                    f"to {destination['path']} ({destination.get('mode', 'copy')})."
+                )
+
+    def submit(self, paths):
+        if self.executor is None:
+            return
+        for path in paths:
+            kind = get_kind(path)
+            for destination in self.destinations:
+                if kind in destination.get("include", KINDS):
+                    self.futures.add(self.executor.submit(self.deliver, path, destination))
+
+    def deliver(self, path, destination):
+        for attempt in range(self.retries + 1):
+            try:
+                deliver_file(path, destination["path"], destination.get("mode", "copy"))
+                return True
+            except OSError as e:
+                if attempt == self.retries:
+                    logger.error(f"Giving up copying {path} to {destination['path']}: {e}")
+                    return False
+                delay = self.retry_seconds * 2**attempt
+                logger.warning(
+                    f"Copying {path} to {destination['path']} failed ({e}), retrying in {delay:.1f} s."
+                )
+                time.sleep(delay)
+
+    def pump(self):
+        for future in [f for f in self.futures if f.done()]:
+            self.futures.discard(future)
+            if future.exception() is not None:
+                logger.error(f"Error distributing files: {future.exception()}")
+
+    def close(self):
+        if self.executor is None:
+            return
+        self.pump()
+        if self.futures:
+            logger.info(f"Waiting for {len(self.futures)} copies to finish.")
+        self.executor.shutdown(wait=True)
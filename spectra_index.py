@@ -0,0 +1,141 @@
+#
+# SQLite sidecar index with per file summaries written by the looper
+#
+
+import os
+import sqlite3
+from datetime import datetime
+import numpy as np
+
+
+def parse_timestamp(filename):
+    """
+    Time stamp from names like 'rsa01-2024.05.20.12.34.56.789.tiq_spectrum.npz'.
+    """
+    timestamp_str = os.path.basename(filename).split('-')[1].split('.tiq')[0]
+    # Same as strptime with '%Y.%m.%d.%H.%M.%S.%f', but much faster
+    year, month, day, hour, minute, second, fraction = timestamp_str.split('.')
+    return datetime(
+        int(year),
+        int(month),
+        int(day),
+        int(hour),
+        int(minute),
+        int(second),
+        int(fraction.ljust(6, '0')[:6]),
+    )
+
+
+def source_name(filename):
+    """
+    Name of the TIQ file a product was made from.
+    """
+    name = os.path.basename(filename)
+    for suffix in ("_spectrogram.npz", "_spectrum.npz"):
+        if name.endswith(suffix):
+            return name[: -len(suffix)]
+    return name
+
+
+def get_spectrogram_summary(ff, zz):
+    """
+    Peak of the time projection of a spectrogram, ff are absolute frequencies.
+    """
+    projection = np.sum(zz, axis=0)
+    peak_bin = int(np.argmax(projection))
+    return {
+        "max_power": float(projection[peak_bin]),
+        "peak_bin": peak_bin,
+        "peak_freq": float(ff[peak_bin]),
+        "projection": projection.astype(np.float32),
+    }
+
+
+def get_spectrum_summary(ff, pp):
+    """
+    Peak frequency of a spectrum, ff are absolute frequencies. Kept apart
+    from peak_freq, which belongs to peak_bin of the spectrogram.
+    """
+    return {"spectrum_peak_freq": float(ff[np.argmax(pp)])}
+
+
+class SpectraIndex:
+    COLUMNS = (
+        "file", "timestamp", "center", "max_power", "peak_bin", "peak_freq", "spectrum_peak_freq"
+    )
+
+    def __init__(self, index_file):
+        self.connection = sqlite3.connect(index_file)
+        # Readers do not block the looper writing
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS spectra (
+                file TEXT PRIMARY KEY,
+                timestamp TEXT,
+                center REAL,
+                max_power REAL,
+                peak_bin INTEGER,
+                peak_freq REAL,
+                projection BLOB,
+                spectrum_peak_freq REAL
+            )"""
+        )
+        # Index files of older versions lack the spectrum peak
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(spectra)")]
+        if "spectrum_peak_freq" not in columns:
+            self.connection.execute("ALTER TABLE spectra ADD COLUMN spectrum_peak_freq REAL")
+        self.connection.commit()
+
+    def add(self, file, center, summary):
+        try:
+            timestamp = parse_timestamp(file).isoformat()
+        except (IndexError, ValueError):
+            timestamp = None
+        projection = summary.get("projection")
+        self.connection.execute(
+            "INSERT OR REPLACE INTO spectra VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                file,
+                timestamp,
+                center,
+                summary.get("max_power"),
+                summary.get("peak_bin"),
+                summary.get("peak_freq"),
+                None if projection is None else projection.tobytes(),
+                summary.get("spectrum_peak_freq"),
+            ),
+        )
+        self.connection.commit()
+
+    def lookup(self, filenames):
+        """
+        Rows for the given product or TIQ file names, keyed by the TIQ name.
+        Files that are not in the index are left out.
+        """
+        names = sorted(set(source_name(f) for f in filenames))
+        rows = {}
+        # Stay below the SQLite limit of variables per statement
+        for i in range(0, len(names), 500):
+            chunk = names[i : i + 500]
+            cursor = self.connection.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM spectra "
+                f"WHERE file IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            )
+            for row in cursor:
+                record = dict(zip(self.COLUMNS, row))
+                if record["timestamp"] is not None:
+                    record["timestamp"] = datetime.fromisoformat(record["timestamp"])
+                rows[record["file"]] = record
+        return rows
+
+    def get_projection(self, file):
+        row = self.connection.execute(
+            "SELECT projection FROM spectra WHERE file = ?", (source_name(file),)
+        ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def close(self):
+        self.connection.close()
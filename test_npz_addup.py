@@ -0,0 +1,84 @@
+#
+# Parallel summation of npz_addup against the serial one
+#
+
+import argparse
+import numpy as np
+import pytest
+
+pytest.importorskip("iqtools")  # npz_addup plots with it
+import npz_addup
+from npz_format import save_spectrogram
+
+NFILES, NROWS, NBINS = 23, 8, 256
+
+
+def write_spectrograms(directory, nfiles, shape=(NROWS, NBINS), seed=0):
+    """
+    Spectrograms with a peak drifting over the files, on random noise so
+    the sum depends on the order of the additions.
+    """
+    rng = np.random.default_rng(seed)
+    ff = 245e6 + np.arange(shape[1]) * 10.0
+    tt = np.arange(shape[0]) * 0.1
+    files = []
+    for i in range(nfiles):
+        zz = rng.random(shape)
+        zz[:, (shape[1] // 2 + i % 5) % shape[1]] += 100.0
+        filename = str(directory / f"rsa01-2026.01.01.12.00.{i:02d}.000.tiq_spectrogram.npz")
+        save_spectrogram(filename, ff, tt, zz, legacy=True)
+        files.append(filename)
+    return files
+
+
+def get_args(file_list, jobs, chunk_size=4):
+    return argparse.Namespace(
+        file_list=file_list,
+        time_cut=None,
+        shift_track=True,
+        peak_window=None,
+        subbin=False,
+        pwr_limit=None,
+        jobs=jobs,
+        chunk_size=chunk_size,
+        index=None,
+        verbose=False,
+    )
+
+
+def write_file_list(directory, files):
+    file_list = directory / "files.txt"
+    file_list.write_text("\n".join(files))
+    return str(file_list)
+
+
+def new_accumulator():
+    return {"files": [], "zz_sum": None, "ff": None, "tt": None, "ref_pos": None}
+
+
+@pytest.mark.parametrize("jobs", [2, 4])
+def test_jobs_give_identical_sum(tmp_path, jobs):
+    file_list = write_file_list(tmp_path, write_spectrograms(tmp_path, NFILES))
+    _, _, zz_serial, _ = npz_addup.process_files(get_args(file_list, 1))
+    _, _, zz_parallel, _ = npz_addup.process_files(get_args(file_list, jobs))
+    assert zz_serial.dtype == np.float64
+    assert np.array_equal(zz_serial, zz_parallel)
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_shape_mismatch_is_skipped(tmp_path, jobs):
+    files = write_spectrograms(tmp_path, NFILES)
+    (tmp_path / "other").mkdir()
+    other = write_spectrograms(tmp_path / "other", 1, shape=(NROWS, NBINS // 2))
+    mixed = files[:5] + other + files[5:]
+
+    # One file per chunk, so the left out file does not move the chunk boundaries
+    accumulator = new_accumulator()
+    _, _, zz_mixed, _ = npz_addup.process_files(
+        get_args(write_file_list(tmp_path, mixed), jobs, chunk_size=1), accumulator
+    )
+    _, _, zz_good, _ = npz_addup.process_files(
+        get_args(write_file_list(tmp_path, files), jobs, chunk_size=1)
+    )
+    assert accumulator["files"] == files
+    assert np.array_equal(zz_mixed, zz_good)
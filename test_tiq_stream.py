@@ -0,0 +1,67 @@
+#
+# Integrated spectrum of the streaming readers against the full length FFT
+#
+
+import numpy as np
+import pytest
+
+from benchmark import write_synthetic_tiq, read_tiq_header
+from tiq_stream import (
+    TERMINATION,
+    get_sample_view,
+    get_streamed_spectrogram,
+    get_integrated_spectrum,
+    check_integrated_spectrum,
+)
+
+NFRAMES, LFRAMES, NAVG = 64, 1024, 2
+
+
+@pytest.fixture
+def iq(tmp_path):
+    filename = str(tmp_path / "rsa01-2026.01.01.12.00.00.000.tiq")
+    write_synthetic_tiq(filename, NFRAMES * LFRAMES, tones=((10e3, 0.5), (-40e3, 0.05)))
+    return read_tiq_header(filename)
+
+
+def get_full_spectrum(iq, nsamples):
+    """
+    Full length FFT of the samples, normalized like iqtools get_fft.
+    """
+    samples = get_sample_view(iq, nsamples)
+    x = (samples[:, 0] + 1j * samples[:, 1]) * iq.scale
+    pp = np.abs(np.fft.fft(x) / nsamples) ** 2 / 2 / TERMINATION
+    ff = np.fft.fftfreq(nsamples, 1 / iq.fs)
+    return np.fft.fftshift(ff), np.fft.fftshift(pp)
+
+
+@pytest.mark.parametrize("mapped", [False, True])
+def test_integrated_spectrum(iq, mapped):
+    ff_int, _, zz = get_streamed_spectrogram(iq, NFRAMES, LFRAMES, NAVG, 16, mapped=mapped)
+    ff, pp = get_full_spectrum(iq, NFRAMES * LFRAMES)
+    assert check_integrated_spectrum(ff, pp, ff_int, get_integrated_spectrum(zz), rtol=1e-9)
+
+
+def test_readers_agree(iq):
+    _, _, zz_stream = get_streamed_spectrogram(iq, NFRAMES, LFRAMES, NAVG, 16)
+    _, _, zz_mapped = get_streamed_spectrogram(iq, NFRAMES, LFRAMES, NAVG, 16, mapped=True)
+    np.testing.assert_allclose(zz_stream, zz_mapped, rtol=1e-12)
+
+
+@pytest.mark.parametrize("mapped", [False, True])
+def test_readers_agree_with_iqtools(iq, mapped):
+    """
+    The "stream" and "mmap" readers of the looper against its default
+    iqtools path, so switching readers keeps the absolute power.
+    """
+    iqtools = pytest.importorskip("iqtools")
+    iq_object = iqtools.get_iq_object(iq.filename)
+    iq_object.read(nframes=NFRAMES, lframes=LFRAMES)
+    xx, yy, zz = iq_object.get_power_spectrogram(nframes=NFRAMES, lframes=LFRAMES)
+    xx, yy, zz = iqtools.get_averaged_spectrogram(xx, yy, zz, every=NAVG)
+
+    iq_object = iqtools.get_iq_object(iq.filename)
+    iq_object.read_header()
+    ff, _, zz_stream = get_streamed_spectrogram(iq_object, NFRAMES, LFRAMES, NAVG, 16, mapped=mapped)
+    np.testing.assert_allclose(ff, xx[0, :])
+    np.testing.assert_allclose(zz_stream, zz, rtol=1e-9)
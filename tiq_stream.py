@@ -0,0 +1,254 @@
+#
+# Block-wise TIQ reading and spectrogram for the looper
+#
+
+import time
+import argparse
+import contextlib
+import numpy as np
+
+TERMINATION = 50  # in Ohms for termination resistor, same as iqtools
+
+
+def get_auto_frames(nsamples_total, nframes="auto", lframes="auto", navg=1, max_rows=0):
+    """
+    Work out "auto" frame settings from the number of samples in a file.
+    lframes becomes the power of two closest to the square root of the
+    number of samples, nframes covers the whole file in multiples of navg.
+    With max_rows, navg is raised so that the spectrogram has at most that
+    many rows. Returns nframes, lframes and navg.
+    """
+    if lframes == "auto":
+        lframes = 2 ** int(round(np.log2(np.sqrt(nsamples_total))))
+    if nframes == "auto":
+        nframes = nsamples_total // lframes
+        if max_rows:
+            navg = max(navg, -(-nframes // max_rows))
+        nframes = nframes // navg * navg
+        if nframes == 0:
+            raise ValueError(
+                f"File has {nsamples_total} samples, less than {navg} frames of {lframes}."
+            )
+    return nframes, lframes, navg
+
+
+def iter_frame_blocks(iq, nframes, lframes, block_frames):
+    """
+    Yield nframes frames of a TIQ file as complex arrays of shape
+    (block_frames, lframes), the last block may be shorter.
+    The header must have been read already.
+    """
+    if nframes * lframes > iq.nsamples_total:
+        raise ValueError(
+            f"Requested {nframes * lframes} samples, file has only {iq.nsamples_total}."
+        )
+
+    with open(iq.filename, "rb") as file:
+        file.seek(iq.data_offset)
+        for start in range(0, nframes, block_frames):
+            n = min(block_frames, nframes - start)
+            # I and Q are interleaved 4 byte little endian integers
+            raw = np.fromfile(file, dtype="<i4", count=2 * n * lframes)
+            if raw.size < 2 * n * lframes:
+                raise ValueError(f"File {iq.filename} ends before the requested frames.")
+            block = raw.astype(np.float64).view(np.complex128)
+            block *= iq.scale  # to Volts
+            yield block.reshape(n, lframes)
+
+
+def get_sample_view(iq, nsamples):
+    """
+    Memory-map the first nsamples of the data section of a TIQ file as a
+    read-only int32 array of shape (nsamples, 2) holding I and Q.
+    """
+    if nsamples > iq.nsamples_total:
+        raise ValueError(
+            f"Requested {nsamples} samples, file has only {iq.nsamples_total}."
+        )
+    return np.memmap(
+        iq.filename,
+        dtype="<i4",
+        mode="r",
+        offset=iq.data_offset,
+        shape=(nsamples, 2),
+    )
+
+
+def get_frame_view(iq, nframes, lframes, samples=None):
+    """
+    The samples as array of shape (nframes, lframes, 2), nothing is copied.
+    Without samples from get_sample_view, the file is mapped.
+    """
+    if samples is None:
+        samples = get_sample_view(iq, nframes * lframes)
+    return samples[: nframes * lframes].reshape(nframes, lframes, 2)
+
+
+def iter_mapped_frame_blocks(iq, nframes, lframes, block_frames, samples=None):
+    """
+    Same as iter_frame_blocks, but on strided views of the mapped file that
+    are converted into one reused buffer. The yielded block is only valid
+    until the next one is requested.
+    """
+    frames = get_frame_view(iq, nframes, lframes, samples)
+    buffer = np.empty((min(block_frames, nframes), lframes), dtype=np.complex128)
+    for start in range(0, nframes, block_frames):
+        view = frames[start : start + block_frames]
+        block = buffer[: len(view)]
+        block.real = view[..., 0]
+        block.imag = view[..., 1]
+        block *= iq.scale  # to Volts
+        yield block
+
+
+def get_frame_power(frames, engine=None):
+    """
+    Power spectrum of each frame (row), frequency axis shifted to the center.
+    All frames are transformed in one call, with the FFTEngine if given.
+    """
+    lframes = np.shape(frames)[1]
+    if engine is not None:
+        v_peak_iq = engine.fft(frames) / lframes
+    else:
+        v_peak_iq = np.fft.fft(frames, axis=1) / lframes
+    p_avg = np.abs(v_peak_iq) ** 2 / 2 / TERMINATION
+    return np.fft.fftshift(p_avg, axes=1)
+
+
+def get_streamed_spectrogram(
+    iq,
+    nframes,
+    lframes,
+    navg,
+    block_frames,
+    mapped=False,
+    engine=None,
+    timer=None,
+    samples=None,
+):
+    """
+    Power spectrogram averaged over every navg frames, reading and
+    transforming block_frames frames at a time. Peak memory is bounded
+    by the block size and the averaged output, not by the file size.
+    With mapped the frames come from a memory-mapped view of the file,
+    engine is an optional FFTEngine doing the transforms. An optional
+    StageTimer gets the time spent in reading, FFT and averaging. Several
+    spectrograms of one file can share the mapping by passing the same
+    samples from get_sample_view.
+
+    Returns the 1D frequency and time axes and the 2D power.
+    """
+    nrows = nframes // navg  # leftover frames do not make a full average
+    block_frames = max(navg, block_frames // navg * navg)
+
+    zz = np.empty((nrows, lframes))
+    row = 0
+    if mapped or samples is not None:
+        blocks = iter_mapped_frame_blocks(iq, nrows * navg, lframes, block_frames, samples)
+    else:
+        blocks = iter_frame_blocks(iq, nrows * navg, lframes, block_frames)
+    stage = timer or (lambda name: contextlib.nullcontext())
+    while True:
+        with stage("read"):
+            block = next(blocks, None)
+        if block is None:
+            break
+        with stage("fft"):
+            pp = get_frame_power(block, engine)
+        with stage("average"):
+            n = len(pp) // navg
+            zz[row : row + n] = pp.reshape(n, navg, lframes).mean(axis=1)
+        row += n
+
+    ff = np.fft.fftshift(np.fft.fftfreq(lframes, 1 / iq.fs))
+    tt = np.arange(nrows) * navg * lframes / iq.fs
+    return ff, tt, zz
+
+
+def get_integrated_spectrum(zz):
+    """
+    Mean power per frequency bin over all rows of a spectrogram. This is the
+    spectrum with the frequency resolution of one frame, the total power is
+    the same as in the full length FFT of the same samples.
+    """
+    return np.mean(zz, axis=0)
+
+
+def compare_integrated_spectrum(ff, pp, ff_int, pp_int):
+    """
+    Total power of the full length spectrum ff, pp and of the integrated
+    one, the offset of their strongest peaks and the bin width of the
+    integrated spectrum, all in a dict.
+    """
+    return {
+        "total": np.sum(pp),
+        "total_int": np.sum(pp_int),
+        "peak_offset": np.abs(ff[np.argmax(pp)] - ff_int[np.argmax(pp_int)]),
+        "df": np.abs(ff_int[1] - ff_int[0]),
+    }
+
+
+def check_integrated_spectrum(ff, pp, ff_int, pp_int, rtol=1e-6):
+    """
+    Compare the full length spectrum ff, pp with the integrated one. The
+    total power has to agree within rtol and the strongest peak has to be
+    within one bin of the integrated spectrum.
+    """
+    result = compare_integrated_spectrum(ff, pp, ff_int, pp_int)
+    return bool(
+        np.isclose(result["total"], result["total_int"], rtol=rtol)
+        and result["peak_offset"] <= result["df"]
+    )
+
+
+def main():
+    # Compare the readers on a real file
+    from iqtools import get_iq_object, get_averaged_spectrogram
+
+    parser = argparse.ArgumentParser(
+        description="Time the iqtools, stream and mmap spectrogram paths on a TIQ file "
+        "and check the integrated spectrum against the full length FFT."
+    )
+    parser.add_argument("filename", help="Path to the TIQ file.")
+    parser.add_argument("--nframes", type=int, default=700)
+    parser.add_argument("--lframes", type=int, default=8192)
+    parser.add_argument("--navg", type=int, default=2)
+    parser.add_argument("--block-frames", type=int, default=64)
+    args = parser.parse_args()
+
+    start_time = time.time()
+    iq = get_iq_object(args.filename)
+    iq.method = "fftw"
+    iq.read(nframes=args.nframes, lframes=args.lframes)
+    xx, yy, zz = iq.get_power_spectrogram(nframes=args.nframes, lframes=args.lframes)
+    get_averaged_spectrogram(xx, yy, zz, every=args.navg)
+    print(f"iqtools: {time.time() - start_time:.3f} s")
+
+    for mapped, name in [(False, "stream"), (True, "mmap")]:
+        start_time = time.time()
+        iq = get_iq_object(args.filename)
+        iq.read_header()
+        get_streamed_spectrogram(
+            iq, args.nframes, args.lframes, args.navg, args.block_frames, mapped=mapped
+        )
+        print(f"{name}: {time.time() - start_time:.3f} s")
+
+    # One pass spectrum against the second full length FFT
+    nframes = args.nframes // args.navg * args.navg
+    iq.read(nframes=nframes, lframes=args.lframes)
+    ff, pp, _ = iq.get_fft()
+    ff_int, _, zz = get_streamed_spectrogram(
+        iq, nframes, args.lframes, args.navg, args.block_frames
+    )
+    pp_int = get_integrated_spectrum(zz)
+    result = compare_integrated_spectrum(ff, pp, ff_int, pp_int)
+    ok = check_integrated_spectrum(ff, pp, ff_int, pp_int)
+    print(
+        f"spectrum: total power {result['total']:.6e} vs {result['total_int']:.6e}, "
+        f"peak offset {result['peak_offset']:.1f} Hz (bin {result['df']:.1f} Hz): "
+        f"{'OK' if ok else 'MISMATCH'}"
+    )
+
+
+if __name__ == "__main__":
+    main()